@@ -1,37 +1,180 @@
+import collections
+import contextlib
+import hashlib
+import importlib
 import json
+import math
+import operator
 import os
+import sqlite3
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+
+# 起動時間の計測は STARTUP_PROFILE=report.json か --profile-startup で有効にする
+# サードパーティのモジュールを読み込む前の時刻とメモリを取っておく
+startup_profile = os.environ.get("STARTUP_PROFILE") or "--profile-startup" in sys.argv
+if startup_profile:
+    tracemalloc.start()
+import_started = (time.perf_counter(), tracemalloc.get_traced_memory()[0])
 
 import dash
-import dash_bio as dashbio
-import dash_canvas
 import dash_core_components as dcc
 import dash_cytoscape as cyto
-import dash_daq as daq
 import dash_html_components as html
 import dash_table
+import flask
 import numpy as np
 import pandas as pd
 import plotly
 import plotly.express as px
 import plotly.graph_objects as go
-import skimage
 from dash.dependencies import Input, Output, State
 from dash.exceptions import PreventUpdate
-from dash_canvas.components import image_upload_zone
-from dash_canvas.utils import (
-    array_to_data_url,
-    image_string_to_PILImage,
-    image_with_contour,
-    parse_jsonstring,
-    superpixel_color_segmentation,
-)
+
+# startup profile
+# -------------------------------------------------------------------------------------
+# 各段階の経過時間と tracemalloc で見たメモリの増分を記録し、最後に JSON で出力する
+
+startup_stages = []
+stage_stack = []
+
+
+def stage_started():
+    return time.perf_counter(), tracemalloc.get_traced_memory()[0]
+
+
+def record_stage(name, started):
+    if startup_profile:
+        startup_stages.append(
+            {
+                "stage": name,
+                "parent": stage_stack[-1] if stage_stack else None,
+                "seconds": round(time.perf_counter() - started[0], 4),
+                "memory_delta": tracemalloc.get_traced_memory()[0] - started[1],
+            }
+        )
+
+
+@contextlib.contextmanager
+def profile_stage(name):
+    started = stage_started()
+    stage_stack.append(name)
+    try:
+        yield
+    finally:
+        stage_stack.pop()
+        record_stage(name, started)
+
+
+record_stage("imports", import_started)
+
+# lazy loading
+# -------------------------------------------------------------------------------------
+# ページのデータや重いモジュールは、初めて使うときに load() で読み込む
+# 本番では PRELOAD="merit,gapminder" や PRELOAD=all で起動時に読んでおける
+
+lazy_loaders = {}
+lazy_values = {}
+lazy_locks = {}  # 名前ごとのロック。遅い読み込みで他の読み込みを止めない
+
+
+def lazy(name, loader=None):
+    if loader is None:
+        return lambda loader: lazy(name, loader)
+    lazy_loaders[name] = loader
+    lazy_locks[name] = threading.RLock()
+    return loader
+
+
+def load(name):
+    if name not in lazy_values:
+        with lazy_locks[name]:
+            if name not in lazy_values:
+                with profile_stage("load " + name):
+                    lazy_values[name] = lazy_loaders[name]()
+    return lazy_values[name]
+
+
+for module_name in [
+    "dash_bio",
+    "dash_canvas",
+    "dash_canvas.utils",
+    "dash_daq",
+    "skimage.io",
+]:
+    lazy(module_name, lambda name=module_name: importlib.import_module(name))
+
 
 # data read
-citydata = pd.read_csv("assets/citydata.csv", index_col=0)
+# CSV の代わりに、文字列をカテゴリコードにした列指向の .npz があればそちらを読む
+# .npz は python application.py --build-assets で作る（CSV より古ければ使わない）
+asset_csvs = [
+    "assets/citydata.csv",
+    "assets/total_tourist_wocumsum.csv",
+    "assets/kyoto_hotel_groupby.csv",
+    "assets/kyoto_hotel_comp.csv",
+]
+
+
+def asset_npz_path(csv_path):
+    return os.path.splitext(csv_path)[0] + ".npz"
+
+
+def build_asset(csv_path):
+    df = pd.read_csv(csv_path, index_col=0)
+    arrays = {"__columns__": np.array(df.columns, dtype=str)}
+    for i, (name, values) in enumerate([("__index__", df.index)] + list(df.items())):
+        key = "__index__" if i == 0 else "col{}".format(i - 1)
+        if values.dtype == object:
+            codes, categories = pd.factorize(values)
+            arrays[key + "_codes"] = codes.astype(np.int32)
+            arrays[key + "_categories"] = np.array(categories, dtype=str)
+        else:
+            arrays[key] = np.asarray(values)
+    np.savez(asset_npz_path(csv_path), **arrays)
+
+
+def load_npz_column(npz, key):
+    if key in npz:
+        return npz[key]
+    codes = npz[key + "_codes"]
+    values = npz[key + "_categories"].astype(object).take(codes)
+    values[codes < 0] = np.nan
+    return values
+
+
+def read_asset(csv_path):
+    npz_path = asset_npz_path(csv_path)
+    if (
+        not os.path.exists(npz_path)
+        or os.path.getmtime(npz_path) < os.path.getmtime(csv_path)
+    ):
+        return pd.read_csv(csv_path, index_col=0)
+    with np.load(npz_path, allow_pickle=False) as npz:
+        columns = npz["__columns__"].tolist()
+        return pd.DataFrame(
+            {
+                name: load_npz_column(npz, "col{}".format(i))
+                for i, name in enumerate(columns)
+            },
+            index=load_npz_column(npz, "__index__"),
+            columns=columns,
+        )
+
+
+lazy("citydata", lambda: read_asset("assets/citydata.csv"))
 
 # image read
 filepath = "assets/me.jpg"
-filename = array_to_data_url(skimage.io.imread(filepath))
+lazy(
+    "canvas_image",
+    lambda: load("dash_canvas.utils").array_to_data_url(
+        load("skimage.io").imread(filepath)
+    ),
+)
 
 # mapbox
 px.set_mapbox_access_token(
@@ -73,9 +216,455 @@ app = app_dash.server
 app_dash.config.suppress_callback_exceptions = True
 
 
+# callback metrics
+# -------------------------------------------------------------------------------------
+# コールバックごとの呼び出し回数、レイテンシ、レスポンスのバイト数、エラー数を記録し
+# /metrics で JSON として返す。キャッシュから返した分も含めるので、先に登録しておく
+# 記録は teardown_request で行う。例外がそのまま上がるとき (PROPAGATE_EXCEPTIONS や
+# debug=True) は after_request が呼ばれないので、そこではレスポンスを覚えておくだけにする
+# warm_callback からのリクエスト (X-Warm-Up ヘッダー付き) は数えない
+
+metrics_window = 1024
+callback_metrics = {}
+metrics_lock = threading.Lock()
+
+
+def callback_name(output):
+    callback = app_dash.callback_map.get(output, {}).get("callback")
+    return getattr(callback, "__name__", output)
+
+
+@app.before_request
+def start_callback_timer():
+    request = flask.request
+    if request.headers.get("X-Warm-Up"):
+        return None
+    if request.method == "POST" and request.path.endswith("_dash-update-component"):
+        body = request.get_json(silent=True) or {}
+        flask.g.callback_started = (body.get("output"), time.perf_counter())
+
+
+@app.after_request
+def remember_callback_response(response):
+    if "callback_started" in flask.g:
+        flask.g.callback_response = (response.status_code, len(response.get_data()))
+    return response
+
+
+@app.teardown_request
+def record_callback_metrics(exc):
+    started = flask.g.pop("callback_started", None)
+    if started is None:
+        return
+    output, start = started
+    latency = time.perf_counter() - start
+    status, size = flask.g.pop("callback_response", (500, 0))
+    with metrics_lock:
+        metrics = callback_metrics.setdefault(
+            output,
+            {
+                "calls": 0,
+                "errors": 0,
+                "cache_hits": 0,
+                "bytes_total": 0,
+                "bytes_max": 0,
+                "latency": collections.deque(maxlen=metrics_window),
+            },
+        )
+        metrics["calls"] += 1
+        if exc is not None or status >= 400:
+            metrics["errors"] += 1
+        if flask.g.pop("figure_cache_hit", False):
+            metrics["cache_hits"] += 1
+        metrics["bytes_total"] += size
+        metrics["bytes_max"] = max(metrics["bytes_max"], size)
+        metrics["latency"].append(latency)
+
+
+@app.route("/metrics")
+def serve_metrics():
+    report = {}
+    with metrics_lock:
+        for output, metrics in callback_metrics.items():
+            latency = np.array(metrics["latency"]) * 1000
+            p50, p95, p99 = np.percentile(latency, [50, 95, 99])
+            report[callback_name(output)] = {
+                "output": output,
+                "calls": metrics["calls"],
+                "errors": metrics["errors"],
+                "cache_hits": metrics["cache_hits"],
+                "bytes_total": metrics["bytes_total"],
+                "bytes_mean": metrics["bytes_total"] // metrics["calls"],
+                "bytes_max": metrics["bytes_max"],
+                "latency_ms": {
+                    "p50": round(p50, 3),
+                    "p95": round(p95, 3),
+                    "p99": round(p99, 3),
+                },
+            }
+    return flask.jsonify({"callbacks": report, "warmup": warmup_report})
+
+
+# callback cache
+# -------------------------------------------------------------------------------------
+# 入力だけで結果が決まるコールバックは、シリアライズ済みのレスポンスを LRU で保持する
+# 同じ入力のリクエストはグラフの作成も JSON 化もせずにそのまま返す
+
+
+class LRUCache:
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+
+# 種類が限られていて追い出す必要のないもの (ページなど) は、一度作ったら持ち続ける
+class PermanentCache:
+    def __init__(self):
+        self._data = {}
+
+    def get(self, key):
+        return self._data.get(key)
+
+    def set(self, key, value):
+        self._data.setdefault(key, value)
+
+
+# gunicorn の複数ワーカーで結果を共有したいときは、ローカルディスクの SQLite を使う
+# 接続はプロセス・スレッドごとに作り、合計サイズが上限を超えたら古いものから消す
+# 上限より大きいレスポンスは入れない。ヒット時の atime の更新はまとめて書き込み、
+# 読み込みのたびに書き込みロックを取らないようにする
+# キーにはコードとライブラリのバージョンを付け、デプロイ前の古いレスポンスは使わない
+class SQLiteCache:
+    touch_interval = 5.0
+
+    def __init__(self, path, max_bytes, version=""):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.version = version
+        self._local = threading.local()
+        self._touched = {}
+        self._touched_at = time.time()
+        self._touch_lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache "
+                "(key TEXT PRIMARY KEY, value BLOB, size INTEGER, atime REAL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS cache_atime ON cache (atime)")
+            conn.execute(
+                "DELETE FROM cache WHERE substr(key, 1, ?) != ?",
+                (len(version), version),
+            )
+
+    def _connect(self):
+        # fork 後に親の接続を使い回さないように pid も見る
+        if getattr(self._local, "pid", None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return self._local.conn
+
+    def _flush_touched(self, conn, force=False):
+        with self._touch_lock:
+            if not self._touched or (
+                not force and time.time() - self._touched_at < self.touch_interval
+            ):
+                return
+            touched, self._touched = self._touched, {}
+            self._touched_at = time.time()
+        conn.executemany(
+            "UPDATE cache SET atime = ? WHERE key = ?",
+            [(atime, key) for key, atime in touched.items()],
+        )
+
+    def get(self, key):
+        key = self.version + key
+        try:
+            with self._connect() as conn:
+                row = conn.execute(
+                    "SELECT value FROM cache WHERE key = ?", (key,)
+                ).fetchone()
+                if row is None:
+                    return None
+                with self._touch_lock:
+                    self._touched[key] = time.time()
+                self._flush_touched(conn)
+                return bytes(row[0])
+        except sqlite3.Error:
+            return None
+
+    def set(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+        key = self.version + key
+        try:
+            with self._connect() as conn:
+                self._flush_touched(conn, force=True)
+                conn.execute(
+                    "INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)",
+                    (key, sqlite3.Binary(value), len(value), time.time()),
+                )
+                conn.execute(
+                    "DELETE FROM cache WHERE key IN ("
+                    "SELECT key FROM (SELECT key, SUM(size) OVER "
+                    "(ORDER BY atime DESC) AS total FROM cache) WHERE total > ?)",
+                    (self.max_bytes,),
+                )
+        except sqlite3.Error:
+            pass
+
+
+def code_version():
+    with open(os.path.abspath(__file__), "rb") as f:
+        digest = hashlib.sha1(f.read()).hexdigest()[:12]
+    return "{}-{}-{}:".format(digest, dash.__version__, plotly.__version__)
+
+
+if os.environ.get("FIGURE_CACHE_PATH"):
+    figure_cache = SQLiteCache(
+        os.environ["FIGURE_CACHE_PATH"],
+        int(os.environ.get("FIGURE_CACHE_BYTES", 64 * 1024 * 1024)),
+        code_version(),
+    )
+else:
+    figure_cache = LRUCache(int(os.environ.get("FIGURE_CACHE_SIZE", 256)))
+memoized_outputs = {}  # callback id -> function that picks the cache key from inputs
+memoized_caches = {}  # callback id -> cache the responses are stored in
+
+
+def callback_id(output):
+    if isinstance(output, (list, tuple)):
+        return "..{}..".format(
+            "...".join(
+                "{}.{}".format(o.component_id, o.component_property) for o in output
+            )
+        )
+    return "{}.{}".format(output.component_id, output.component_property)
+
+
+def memoized_callback(output, inputs, state=None, key=None, cache=None, **kwargs):
+    memoized_outputs[callback_id(output)] = key
+    memoized_caches[callback_id(output)] = figure_cache if cache is None else cache
+    return app_dash.callback(output, inputs, state or [], **kwargs)
+
+
+def figure_cache_key(body):
+    if body.get("output") not in memoized_outputs:
+        return None
+    values = [i.get("value") for i in body.get("inputs", [])]
+    values += [s.get("value") for s in body.get("state", [])]
+    key = memoized_outputs[body["output"]]
+    if key is not None:
+        try:
+            values = key(*values)
+        except (KeyError, IndexError, TypeError):
+            return None
+    return body["output"] + json.dumps(values, sort_keys=True)
+
+
+# コールバックを HTTP 経由で一度呼んで、レスポンスをキャッシュに載せておく
+def warm_callback(output, inputs, values):
+    if isinstance(output, (list, tuple)):
+        outputs = [
+            {"id": o.component_id, "property": o.component_property} for o in output
+        ]
+    else:
+        outputs = {"id": output.component_id, "property": output.component_property}
+    body = {
+        "output": callback_id(output),
+        "outputs": outputs,
+        "inputs": [
+            {"id": i.component_id, "property": i.component_property, "value": v}
+            for i, v in zip(inputs, values)
+        ],
+        "changedPropIds": [],
+        "state": [],
+    }
+    response = app.test_client().post(
+        "/_dash-update-component", json=body, headers={"X-Warm-Up": "1"}
+    )
+    return response.status_code
+
+
+@app.before_request
+def serve_cached_figure():
+    request = flask.request
+    if request.method != "POST" or not request.path.endswith("_dash-update-component"):
+        return None
+    body = request.get_json(silent=True) or {}
+    key = figure_cache_key(body)
+    if key is None:
+        return None
+    cache = memoized_caches[body["output"]]
+    cached = cache.get(key)
+    if cached is not None:
+        flask.g.figure_cache_hit = True
+        return flask.Response(cached, mimetype="application/json")
+    flask.g.figure_cache_entry = (cache, key)
+
+
+@app.after_request
+def store_cached_figure(response):
+    cache, key = flask.g.pop("figure_cache_entry", (None, None))
+    if key is not None and response.status_code == 200:
+        cache.set(key, response.get_data())
+    return response
+
+
+# server-side DataTable
+# -------------------------------------------------------------------------------------
+# ページ分け、フィルタ、並べ替えをサーバー側で行い、ブラウザには今のページの行だけを送る
+# filter_query は numpy のマスクに、sort_by は並べ替えの順列にして、順列はキャッシュする
+
+filter_operators = [
+    ["ge ", ">="],
+    ["le ", "<="],
+    ["lt ", "<"],
+    ["gt ", ">"],
+    ["ne ", "!="],
+    ["eq ", "="],
+    ["contains "],
+    ["datestartswith "],
+]
+filter_comparisons = {
+    "ge": operator.ge,
+    "le": operator.le,
+    "lt": operator.lt,
+    "gt": operator.gt,
+    "ne": operator.ne,
+    "eq": operator.eq,
+}
+sort_permutations = LRUCache(128)
+
+
+# "{列名} 演算子 値" の形だけを受け付ける。列名の直後の字句を演算子として読むので、
+# 引用符で囲んだ値の中の "ne " や "le " などは演算子と取り違えない
+def split_filter_part(filter_part):
+    filter_part = filter_part.strip()
+    close = filter_part.find("}")
+    if not filter_part.startswith("{") or close < 0:
+        return None, None, None
+    name = filter_part[1:close]
+    rest = filter_part[close + 1 :].lstrip()
+    for operator_type in filter_operators:
+        for op in operator_type:
+            if rest.startswith(op):
+                value_part = rest[len(op) :].strip()
+                v0 = value_part[:1]
+                if (
+                    len(value_part) > 1
+                    and v0 == value_part[-1]
+                    and v0 in ("'", '"', "`")
+                ):
+                    value = value_part[1:-1].replace("\\" + v0, v0)
+                else:
+                    try:
+                        value = float(value_part)
+                    except ValueError:
+                        value = value_part
+                return name, operator_type[0].strip(), value
+    return None, None, None
+
+
+def filter_mask(df, filter_query):
+    mask = np.ones(len(df), dtype=bool)
+    for filter_part in (filter_query or "").split(" && "):
+        name, op, value = split_filter_part(filter_part)
+        if name not in df.columns:
+            continue
+        column = df[name]
+        if op in filter_comparisons:
+            if isinstance(value, float):
+                column = pd.to_numeric(column, errors="coerce")
+            else:
+                column = column.astype(str)
+            mask &= filter_comparisons[op](column.to_numpy(), value)
+        elif op == "contains":
+            mask &= column.astype(str).str.contains(str(value), regex=False).to_numpy()
+        elif op == "datestartswith":
+            mask &= column.astype(str).str.startswith(str(value)).to_numpy()
+    return mask
+
+
+# name を渡したときは、同じデータの同じ並べ替えの順列を使い回す
+def sort_permutation(df, sort_by, name=None):
+    key = None
+    if name is not None:
+        key = (name,) + tuple((s["column_id"], s["direction"]) for s in sort_by)
+        permutation = sort_permutations.get(key)
+        if permutation is not None:
+            return permutation
+    keys = []
+    for s in reversed(sort_by):
+        codes = pd.factorize(df[s["column_id"]], sort=True)[0]
+        keys.append(-codes if s["direction"] == "desc" else codes)
+    permutation = np.lexsort(keys) if keys else np.arange(len(df))
+    if key is not None:
+        sort_permutations.set(key, permutation)
+    return permutation
+
+
+def table_order(df, filter_query=None, sort_by=None, name=None):
+    permutation = sort_permutation(df, sort_by or [], name)
+    return permutation[filter_mask(df, filter_query)[permutation]]
+
+
+def table_view(df, page_current, page_size, filter_query=None, sort_by=None, name=None):
+    order = table_order(df, filter_query, sort_by, name)
+    start = (page_current or 0) * page_size
+    page = df.iloc[order[start : start + page_size]].to_dict("records")
+    return page, max(1, math.ceil(len(order) / page_size))
+
+
+def paged_table(table_id, columns, df, page_size, **kwargs):
+    data, page_count = table_view(df, 0, page_size)
+    return dash_table.DataTable(
+        id=table_id,
+        columns=[{"id": i, "name": i} for i in columns],
+        data=data,
+        page_action="custom",
+        page_current=0,
+        page_size=page_size,
+        page_count=page_count,
+        filter_action="custom",
+        filter_query="",
+        sort_action="custom",
+        sort_mode="multi",
+        sort_by=[],
+        **kwargs
+    )
+
+
+def paged_table_inputs(table_id):
+    return [
+        Input(table_id, "page_current"),
+        Input(table_id, "page_size"),
+        Input(table_id, "filter_query"),
+        Input(table_id, "sort_by"),
+    ]
+
+
 # layout
 # -------------------------------------------------------------------------------------
 
+layout_started = stage_started()
 app_dash.layout = html.Div(
     [
         html.Div(
@@ -143,6 +732,7 @@ app_dash.layout = html.Div(
     ],
     style={"width": "95%", "margin": "auto"},
 )
+record_stage("app layout", layout_started)
 
 title = html.Div(
     [
@@ -214,70 +804,78 @@ web_app = html.Div(
     ]
 )
 
-self_intro = html.Div(
-    [
-        head_title("你好，自我介绍"),
-        html.Div(
-            [
-                html.Div(
-                    [
-                        html.Img(
-                            src="assets/me.jpg", style={"width": "60%", "margin": "20%"}
-                        ),
-                        html.Img(
-                            src="assets/hannnari.png",
-                            style={"width": "60%", "marginLeft": "20%"},
-                        ),
-                    ]
-                )
-            ],
-            style={"width": "40%", "float": "left"},
-        ),
-        html.Div(
-            [
-                html.Div(
-                    [
-                        html.P("我叫 小川 英幸（wechat： hide_xiao）"),
-                        html.Div(
-                            [
-                                html.P("我的事业"),
-                                html.P(
-                                    "· I worked as a trader and analyst at Financial Institute."
-                                ),
-                                html.P(
-                                    "· I started using Python 5 years ago(for data analysis)."
-                                ),
-                                html.P("· I founded a company named Chomoku(长目)."),
-                            ]
-                        ),
-                        html.P("我来自,日本京都（你知吗？）"),
-                        dcc.Graph(
-                            figure=px.scatter_mapbox(
-                                citydata,
-                                lat="lat",
-                                lon="long",
-                                text="city",
-                                size="pop",
-                                color="pop",
-                                zoom=3,
-                                color_continuous_scale=px.colors.sequential.Rainbow,
-                            )
-                        ),
-                        html.Br(),
-                        html.P("はんなり == 优雅(you1ya3)"),
-                        html.P("优雅Python 在每个第三个星期五 "),
-                    ],
-                    style={"fontSize": 25, "margin": "5%"},
-                )
-            ],
-            style={"width": "60%", "display": "inline-block"},
-        ),
-        html.Div(
-            [dcc.Link("Next: 为什么我来 PyCon CHINA 北京？", href="/reasons")],
-            style={"textAlign": "right", "margin": "5%"},
-        ),
-    ]
-)
+
+@lazy("self_intro")
+def self_intro_layout():
+    citydata = load("citydata")
+    return html.Div(
+        [
+            head_title("你好，自我介绍"),
+            html.Div(
+                [
+                    html.Div(
+                        [
+                            html.Img(
+                                src="assets/me.jpg",
+                                style={"width": "60%", "margin": "20%"},
+                            ),
+                            html.Img(
+                                src="assets/hannnari.png",
+                                style={"width": "60%", "marginLeft": "20%"},
+                            ),
+                        ]
+                    )
+                ],
+                style={"width": "40%", "float": "left"},
+            ),
+            html.Div(
+                [
+                    html.Div(
+                        [
+                            html.P("我叫 小川 英幸（wechat： hide_xiao）"),
+                            html.Div(
+                                [
+                                    html.P("我的事业"),
+                                    html.P(
+                                        "· I worked as a trader and analyst at Financial Institute."
+                                    ),
+                                    html.P(
+                                        "· I started using Python 5 years ago(for data analysis)."
+                                    ),
+                                    html.P(
+                                        "· I founded a company named Chomoku(长目)."
+                                    ),
+                                ]
+                            ),
+                            html.P("我来自,日本京都（你知吗？）"),
+                            dcc.Graph(
+                                figure=px.scatter_mapbox(
+                                    citydata,
+                                    lat="lat",
+                                    lon="long",
+                                    text="city",
+                                    size="pop",
+                                    color="pop",
+                                    zoom=3,
+                                    color_continuous_scale=px.colors.sequential.Rainbow,
+                                )
+                            ),
+                            html.Br(),
+                            html.P("はんなり == 优雅(you1ya3)"),
+                            html.P("优雅Python 在每个第三个星期五 "),
+                        ],
+                        style={"fontSize": 25, "margin": "5%"},
+                    )
+                ],
+                style={"width": "60%", "display": "inline-block"},
+            ),
+            html.Div(
+                [dcc.Link("Next: 为什么我来 PyCon CHINA 北京？", href="/reasons")],
+                style={"textAlign": "right", "margin": "5%"},
+            ),
+        ]
+    )
+
 
 reasons = html.Div(
     [
@@ -346,309 +944,679 @@ menu = html.Div(
 # 訪日観光客データ　https://www.jnto.go.jp/jpn/statistics/visitor_trends/
 
 
-jpvisit = pd.read_csv("assets/total_tourist_wocumsum.csv", index_col=0)
 ex_area = ["総数", "アジア計", "北アメリカ計", "ヨーロッパ計", "オセアニア計", "南アメリカ計", "アフリカ計"]
-jpvisit1 = jpvisit[~jpvisit["country"].isin(ex_area)]
+lazy("jpvisit", lambda: read_asset("assets/total_tourist_wocumsum.csv"))
+lazy("jpvisit1", lambda: load("jpvisit")[~load("jpvisit")["country"].isin(ex_area)])
+
+# 年ごとの国別ランキングは年だけで決まるので、起動時に一度だけ作っておく
+rank_top_n = 10
+
+
+def build_year_rank_index(df, top_n=rank_top_n):
+    pivR = df.groupby(["year", "country"])["value"].sum().reset_index()
+    pivR = pivR.sort_values(by=["year", "value"], ascending=[True, False])
+    return {
+        year: dfy[["country", "year", "value"]][:top_n].reset_index(drop=True)
+        for year, dfy in pivR.groupby("year", sort=False)
+    }
+
+
+def year_rank_frame(year_select):
+    return load("year_rank_index").get(
+        year_select, pd.DataFrame(columns=["country", "year", "value"])
+    )
+
+
+lazy("year_rank_index", lambda: build_year_rank_index(load("jpvisit1")))
 
-df_kyoto_hotels_groupby = pd.read_csv("assets/kyoto_hotel_groupby.csv", index_col=0)
-df_kyoto_hotels = pd.read_csv("assets/kyoto_hotel_comp.csv", index_col=0)
+
+# 国ごとの月次データを連続した numpy 配列に分けておく
+# "総数" は日付で揃えておき、比率も先に計算しておく
+def build_tourist_store(df, total_country="総数"):
+    store = {}
+    for country, dfc in df.groupby("country", sort=False):
+        store[country] = {
+            "date": np.ascontiguousarray(dfc["date"].to_numpy()),
+            "value": np.ascontiguousarray(dfc["value"].to_numpy(dtype=float)),
+        }
+
+    total_date = store[total_country]["date"]
+    total_value = store[total_country]["value"]
+    for series in store.values():
+        pos = np.searchsorted(total_date, series["date"])
+        pos = np.minimum(pos, len(total_date) - 1)
+        found = total_date[pos] == series["date"]
+        series["total"] = np.where(found, total_value[pos], np.nan)
+        series["ratio"] = series["value"] / series["total"]
+    return store
+
+
+lazy("tourist_store", lambda: build_tourist_store(load("jpvisit")))
+
+lazy("df_kyoto_hotels_groupby", lambda: read_asset("assets/kyoto_hotel_groupby.csv"))
+lazy("df_kyoto_hotels", lambda: read_asset("assets/kyoto_hotel_comp.csv"))
 mapbox_accesstoken = "your_token"
 
-merit = html.Div(
-    [
-        html.Div(
-            [
-                head_title("Merit of Interactive data visualization"),
-                html.Div(
-                    [
-                        dcc.Markdown(
-                            """
+# 点の数がしきい値を超えたら、散布図は WebGL (Scattergl) で、地図は密度レイヤーで描く
+webgl_threshold = int(os.environ.get("WEBGL_THRESHOLD", 1000))
+map_density_threshold = int(os.environ.get("MAP_DENSITY_THRESHOLD", 10000))
+
+
+def render_mode(n_points):
+    return "webgl" if n_points > webgl_threshold else "svg"
+
+
+# ホテルデータは年代・年ごとに一度だけ並べ替えておき、
+# 地図のトレースは配列のスライスから作る
+def build_hotel_groups(df, key):
+    codes, labels = pd.factorize(df[key])
+    order = np.argsort(codes, kind="stable")
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(codes))])
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    return {
+        "labels": list(labels),
+        "slices": {
+            label: slice(offsets[i], offsets[i + 1]) for i, label in enumerate(labels)
+        },
+        "rank": rank,
+        "ido": df["ido"].to_numpy()[order],
+        "keido": df["keido"].to_numpy()[order],
+        "hotel_name": df["hotel_name"].to_numpy()[order],
+    }
+
+
+# ホテルの位置を約 500m 四方の格子に分け、格子の番号順に並べた行番号を持っておく
+# 範囲や半径の問い合わせは、重なる格子の区間だけを取り出してから絞り込む
+hotel_grid_cell = 0.005
+km_per_degree = 111.32
+
+
+def build_hotel_grid(df, cell=hotel_grid_cell):
+    lat = df["ido"].to_numpy(dtype=float)
+    lon = df["keido"].to_numpy(dtype=float)
+    lat_cell = np.floor(lat / cell).astype(np.int64)
+    lon_cell = np.floor(lon / cell).astype(np.int64)
+    origin = (int(lat_cell.min()), int(lon_cell.min()))
+    lat_cell -= origin[0]
+    lon_cell -= origin[1]
+    shape = (int(lat_cell.max()) + 1, int(lon_cell.max()) + 1)
+    keys = lat_cell * shape[1] + lon_cell
+    order = np.argsort(keys, kind="stable")
+    return {
+        "cell": cell,
+        "origin": origin,
+        "shape": shape,
+        "keys": keys[order],
+        "order": order,
+        "lat": lat,
+        "lon": lon,
+    }
+
+
+lazy("hotel_grid", lambda: build_hotel_grid(load("df_kyoto_hotels")))
+
+
+def hotels_in_bounds(grid, lat0, lat1, lon0, lon1):
+    cell, (rows, cols) = grid["cell"], grid["shape"]
+    r0 = max(int(np.floor(lat0 / cell)) - grid["origin"][0], 0)
+    r1 = min(int(np.floor(lat1 / cell)) - grid["origin"][0], rows - 1)
+    c0 = max(int(np.floor(lon0 / cell)) - grid["origin"][1], 0)
+    c1 = min(int(np.floor(lon1 / cell)) - grid["origin"][1], cols - 1)
+    if r0 > r1 or c0 > c1:
+        return np.empty(0, dtype=np.int64)
+    row_keys = np.arange(r0, r1 + 1) * cols
+    starts = np.searchsorted(grid["keys"], row_keys + c0)
+    stops = np.searchsorted(grid["keys"], row_keys + c1, side="right")
+    found = np.concatenate([grid["order"][a:b] for a, b in zip(starts, stops)])
+    lat, lon = grid["lat"][found], grid["lon"][found]
+    inside = (lat >= lat0) & (lat <= lat1) & (lon >= lon0) & (lon <= lon1)
+    return np.sort(found[inside])
+
+
+# 近い順に行番号と距離 (km) を返す。距離は正距円筒図法の近似で十分
+def hotels_near(grid, lat, lon, radius_km):
+    dlat = radius_km / km_per_degree
+    dlon = dlat / np.cos(np.radians(lat))
+    found = hotels_in_bounds(grid, lat - dlat, lat + dlat, lon - dlon, lon + dlon)
+    distance = km_per_degree * np.hypot(
+        grid["lat"][found] - lat,
+        (grid["lon"][found] - lon) * np.cos(np.radians(lat)),
+    )
+    found, distance = found[distance <= radius_km], distance[distance <= radius_km]
+    near = np.argsort(distance, kind="stable")
+    return found[near], distance[near]
+
+
+# 地図のズームに合わせて、画面上でおよそ hotel_cluster_pixels 四方の格子ごとに
+# ホテルをまとめて送る。hotel_detail_zoom 以上では一軒ずつ送る
+# 格子は経緯度 0 を基準に揃えているので、表示範囲も格子の番号で表しキャッシュの鍵にする
+hotel_map_zoom = 12
+hotel_detail_zoom = 15
+hotel_cluster_pixels = 60
+
+
+def hotel_cell_size(zoom):
+    return 360 / 2**zoom * hotel_cluster_pixels / 256
+
+
+def hotel_map_view(relayoutData):
+    relayoutData = relayoutData or {}
+    zoom = int(relayoutData.get("mapbox.zoom", hotel_map_zoom))
+    view = {"zoom": zoom, "cells": None}
+    derived = relayoutData.get("mapbox._derived")
+    if derived and derived.get("coordinates"):
+        cell = hotel_cell_size(zoom)
+        lons, lats = zip(*derived["coordinates"])
+        view["cells"] = [
+            int(np.floor(min(lats) / cell)),
+            int(np.floor(max(lats) / cell)),
+            int(np.floor(min(lons) / cell)),
+            int(np.floor(max(lons) / cell)),
+        ]
+    return view
+
+
+def hotel_points(groups, sl, view):
+    if view["cells"] is not None:
+        cell = hotel_cell_size(view["zoom"])
+        lat0, lat1, lon0, lon1 = view["cells"]
+        rows = hotels_in_bounds(
+            load("hotel_grid"),
+            lat0 * cell,
+            (lat1 + 1) * cell,
+            lon0 * cell,
+            (lon1 + 1) * cell,
+        )
+        sorted_rows = np.sort(groups["rank"][rows])
+        sl = sorted_rows[(sorted_rows >= sl.start) & (sorted_rows < sl.stop)]
+    return groups["ido"][sl], groups["keido"][sl], groups["hotel_name"][sl]
+
+
+def cluster_hotels(lat, lon, text, zoom):
+    cell = hotel_cell_size(zoom)
+    cells = np.stack([np.floor(lat / cell), np.floor(lon / cell)], axis=1)
+    if len(cells) == 0:
+        return lat, lon, text, []
+    _, inverse, counts = np.unique(
+        cells, axis=0, return_inverse=True, return_counts=True
+    )
+    inverse = inverse.ravel()
+    first = np.full(len(counts), len(lat))
+    np.minimum.at(first, inverse, np.arange(len(lat)))
+    labels = np.where(
+        counts == 1,
+        text[first],
+        np.char.add(counts.astype(str), " hotels").astype(object),
+    )
+    return (
+        np.bincount(inverse, weights=lat) / counts,
+        np.bincount(inverse, weights=lon) / counts,
+        labels,
+        np.minimum(9 + 4 * np.sqrt(counts - 1), 40),
+    )
+
+
+def hotel_traces(groups, labels, named=True, view=None):
+    view = view or hotel_map_view(None)
+    points = [
+        hotel_points(groups, groups["slices"].get(label, slice(0, 0)), view)
+        for label in labels
+    ]
+    if sum(len(lat) for lat, _, _ in points) > map_density_threshold:
+        return [
+            go.Densitymapbox(
+                lat=np.concatenate([lat for lat, _, _ in points]),
+                lon=np.concatenate([lon for _, lon, _ in points]),
+                radius=8,
+            )
+        ]
+    traces = []
+    for label, (lat, lon, text) in zip(labels, points):
+        size = 9
+        if view["zoom"] < hotel_detail_zoom:
+            lat, lon, text, size = cluster_hotels(lat, lon, text, view["zoom"])
+        trace = go.Scattermapbox(
+            lat=lat, lon=lon, mode="markers", marker=dict(size=size), text=text
+        )
+        if named:
+            trace.name = str(label)
+        traces.append(trace)
+    return traces
+
+
+lazy("hotels_by_age", lambda: build_hotel_groups(load("df_kyoto_hotels"), "age"))
+lazy("hotels_by_year", lambda: build_hotel_groups(load("df_kyoto_hotels"), "year"))
+lazy(
+    "hotel_map_center",
+    lambda: dict(
+        lat=np.mean(load("df_kyoto_hotels")["ido"]),
+        lon=np.mean(load("df_kyoto_hotels")["keido"]),
+    ),
+)
+
+
+def hotel_map_layout():
+    return go.Layout(
+        autosize=True,
+        hovermode="closest",
+        mapbox=dict(
+            accesstoken=mapbox_accesstoken,
+            center=load("hotel_map_center"),
+            pitch=90,
+            zoom=hotel_map_zoom,
+        ),
+        height=600,
+        uirevision="hotel-map",
+    )
+
+
+@lazy("merit")
+def merit_layout():
+    jpvisit = load("jpvisit")
+    jpvisit1 = load("jpvisit1")
+    df_kyoto_hotels_groupby = load("df_kyoto_hotels_groupby")
+    return html.Div(
+        [
+            html.Div(
+                [
+                    head_title("Merit of Interactive data visualization"),
+                    html.Div(
+                        [
+                            dcc.Markdown(
+                                """
             At first, Let's feel the merit of Interactive Data Visualization.    
             (Data: Number of Tourist in Japan, Number of permission of hotel in Kyoto)
             """,
-                            style=mkstyle_ins,
-                        )
-                    ],
-                    style=mkstyle_ous,
-                ),
-                html.Div(
-                    [
-                        html.Div(
-                            [
-                                html.H2(
-                                    "Number of Foreign tourists in Japan(by country Top10: yearly)",
-                                    style={"textAlign": "center"},
-                                )
-                            ],
-                            style={"backgroundColor": "#fbffb9"},
-                        ),
-                        dcc.Dropdown(
-                            id="year_select_dd",
-                            options=[
-                                {"label": y, "value": y}
-                                for y in jpvisit1["year"].unique()
-                            ],
-                            value=2019,
-                            clearable=False,
-                            style={
-                                "height": 30,
-                                "width": "40%",
-                                "margin": "auto",
-                                "fontSize": 25,
-                                "textAlign": "center",
-                            },
-                        ),
-                    ]
-                ),
-                html.Div(
-                    id="year_tourist_rank",
-                    style={"width": "50%", "margin": "5% auto 5%"},
-                ),
-            ]
-        ),
-        html.Div(
-            [html.H2("Number of tourist in japan(monthly)", style={"textAlign": "center"})],
-            style={"backgroundColor": "#fbffb9"},
-        ),
-        html.Div(
-            [
-                dcc.Dropdown(
-                    id="tourist_country_dd",
-                    options=[
-                        {"label": country, "value": country}
-                        for country in jpvisit["country"].unique()
-                    ],
-                    value="中国",
-                    clearable=False,
-                    style={"fontSize": 25, "height": 30, "textAlign": "center"},
-                )
-            ],
-            style={"width": "40%", "margin": "auto"},
-        ),
-        html.Div(
-            [
-                html.Div(
-                    [
-                        html.Div(
-                            [dcc.Graph(id="tourist_graph")],
-                            style={"float": "left", "width": "50%"},
-                        ),
-                        html.Div(
-                            [dcc.Graph(id="all_tourist_graph")],
-                            style={"display": "inline-block", "width": "50%"},
-                        ),
-                    ]
-                ),
-                dcc.Graph(id="country_tourist_ratio"),
-            ],
-            style={"margin": "3%"},
-        ),
-        html.Div(
-            [
-                html.Div(
-                    [
-                        html.H2(
-                            "What happens?: Lack of Hotels!",
-                            style={"textAlign": "center"},
-                        )
-                    ],
-                    style={"backgroundColor": "#fbffb9"},
-                ),
-                html.Div(
-                    [
-                        dcc.Markdown(
-                            """
+                                style=mkstyle_ins,
+                            )
+                        ],
+                        style=mkstyle_ous,
+                    ),
+                    html.Div(
+                        [
+                            html.Div(
+                                [
+                                    html.H2(
+                                        "Number of Foreign tourists in Japan(by country Top10: yearly)",
+                                        style={"textAlign": "center"},
+                                    )
+                                ],
+                                style={"backgroundColor": "#fbffb9"},
+                            ),
+                            dcc.Dropdown(
+                                id="year_select_dd",
+                                options=[
+                                    {"label": y, "value": y}
+                                    for y in jpvisit1["year"].unique()
+                                ],
+                                value=2019,
+                                clearable=False,
+                                style={
+                                    "height": 30,
+                                    "width": "40%",
+                                    "margin": "auto",
+                                    "fontSize": 25,
+                                    "textAlign": "center",
+                                },
+                            ),
+                        ]
+                    ),
+                    html.Div(
+                        id="year_tourist_rank",
+                        style={"width": "50%", "margin": "5% auto 5%"},
+                    ),
+                ]
+            ),
+            html.Div(
+                [
+                    html.H2(
+                        "Number of tourist in japan(monthly)",
+                        style={"textAlign": "center"},
+                    )
+                ],
+                style={"backgroundColor": "#fbffb9"},
+            ),
+            html.Div(
+                [
+                    dcc.Dropdown(
+                        id="tourist_country_dd",
+                        options=[
+                            {"label": country, "value": country}
+                            for country in jpvisit["country"].unique()
+                        ],
+                        value="中国",
+                        clearable=False,
+                        style={"fontSize": 25, "height": 30, "textAlign": "center"},
+                    ),
+                    dcc.Store(id="tourist_width"),
+                ],
+                style={"width": "40%", "margin": "auto"},
+            ),
+            html.Div(
+                [
+                    html.Div(
+                        [
+                            html.Div(
+                                [dcc.Graph(id="tourist_graph")],
+                                style={"float": "left", "width": "50%"},
+                            ),
+                            html.Div(
+                                [dcc.Graph(id="all_tourist_graph")],
+                                style={"display": "inline-block", "width": "50%"},
+                            ),
+                        ]
+                    ),
+                    dcc.Graph(id="country_tourist_ratio"),
+                ],
+                style={"margin": "3%"},
+            ),
+            html.Div(
+                [
+                    html.Div(
+                        [
+                            html.H2(
+                                "What happens?: Lack of Hotels!",
+                                style={"textAlign": "center"},
+                            )
+                        ],
+                        style={"backgroundColor": "#fbffb9"},
+                    ),
+                    html.Div(
+                        [
+                            dcc.Markdown(
+                                """
                 There are not enough rooms to stay. So people rushed buying hotels and rooms!
             """,
-                            style=mkstyle_ins,
-                        )
-                    ],
-                    style=mkstyle_ous,
-                ),
-                html.Div(
-                    [
-                        html.Div(
-                            [
-                                html.H2(
-                                    "Increase of kyoto hotel.",
-                                    style={"textAlign": "center"},
-                                )
-                            ],
-                            style={"backgroundColor": "#fbffb9"},
-                        ),
-                        html.Div(
-                            [
-                                dcc.Graph(
-                                    figure={
-                                        "data": [
-                                            go.Bar(
-                                                x=df_kyoto_hotels_groupby["year"],
-                                                y=df_kyoto_hotels_groupby["count"],
-                                            )
-                                        ]
-                                    }
-                                )
-                            ]
-                        ),
-                        html.Div(
-                            [
-                                dcc.Markdown(
-                                    """
+                                style=mkstyle_ins,
+                            )
+                        ],
+                        style=mkstyle_ous,
+                    ),
+                    html.Div(
+                        [
+                            html.Div(
+                                [
+                                    html.H2(
+                                        "Increase of kyoto hotel.",
+                                        style={"textAlign": "center"},
+                                    )
+                                ],
+                                style={"backgroundColor": "#fbffb9"},
+                            ),
+                            html.Div(
+                                [
+                                    dcc.Graph(
+                                        figure={
+                                            "data": [
+                                                go.Bar(
+                                                    x=df_kyoto_hotels_groupby["year"],
+                                                    y=df_kyoto_hotels_groupby["count"],
+                                                )
+                                            ]
+                                        }
+                                    )
+                                ]
+                            ),
+                            html.Div(
+                                [
+                                    dcc.Markdown(
+                                        """
                             - And I wanted too!!
                             - So I want information about real-estate situation.But no one give me.     
                             - Graph above is not for investment decision.    
                             - So I make my interactive data visualization!     
                             """,
-                                    style=mkstyle_ins,
-                                )
-                            ],
-                            style=mkstyle_ous,
-                        ),
-                    ],
-                    style={"width": "90%", "margin": "3% auto 3%"},
-                ),
-                html.Div(
-                    [
-                        html.Div(
-                            [html.H2("Interactive", style={"textAlign": "center"})],
-                            style={"backgroundColor": "#fbffb9"},
-                        ),
-                        html.Div(
-                            [
-                                html.H4(
-                                    id="year-number", style={"textAlign": "center"}
-                                ),
-                                dcc.Graph(
-                                    id="kyoto-hotel-bar",
-                                    figure={
-                                        "data": [
-                                            go.Bar(
-                                                x=df_kyoto_hotels_groupby["year"],
-                                                y=df_kyoto_hotels_groupby["count"],
-                                            )
-                                        ],
-                                        "layout": go.Layout(height=300),
-                                    },
-                                    clickData={"points": [{"x": "all"}]},
-                                ),
-                                dcc.Graph(id="kyoto-hotelmap-yearcallback"),
-                                dcc.Link(
-                                    "Data from Kyoto City: I added geo data",
-                                    href="https://data.city.kyoto.lg.jp/node/100228",
-                                    style={"marginLeft": "60%"},
-                                ),
-                                html.Div(
-                                    [
-                                        dcc.Markdown(
-                                            """
+                                        style=mkstyle_ins,
+                                    )
+                                ],
+                                style=mkstyle_ous,
+                            ),
+                        ],
+                        style={"width": "90%", "margin": "3% auto 3%"},
+                    ),
+                    html.Div(
+                        [
+                            html.Div(
+                                [html.H2("Interactive", style={"textAlign": "center"})],
+                                style={"backgroundColor": "#fbffb9"},
+                            ),
+                            html.Div(
+                                [
+                                    html.H4(
+                                        id="year-number", style={"textAlign": "center"}
+                                    ),
+                                    dcc.Graph(
+                                        id="kyoto-hotel-bar",
+                                        figure={
+                                            "data": [
+                                                go.Bar(
+                                                    x=df_kyoto_hotels_groupby["year"],
+                                                    y=df_kyoto_hotels_groupby["count"],
+                                                )
+                                            ],
+                                            "layout": go.Layout(height=300),
+                                        },
+                                        clickData={"points": [{"x": "all"}]},
+                                    ),
+                                    dcc.Graph(id="kyoto-hotelmap-yearcallback"),
+                                    html.Div(
+                                        id="hotels-near-click",
+                                        style={"margin": "0 10%"},
+                                    ),
+                                    dcc.Link(
+                                        "Data from Kyoto City: I added geo data",
+                                        href="https://data.city.kyoto.lg.jp/node/100228",
+                                        style={"marginLeft": "60%"},
+                                    ),
+                                    html.Div(
+                                        [
+                                            dcc.Markdown(
+                                                """
                                 * The map shows where hotels are and where is popular or unpopular.     
                                 * I think this sample shows merit of interactive data visualization.    
                                 * Interactive data visualization gives us more information and helps us to understand circumstances.                     
                                 * I think it is necessary for decisions.  
                                 """,
-                                            style=mkstyle_ins,
-                                        )
-                                    ],
-                                    style=mkstyle_ous,
-                                ),
-                                html.Div(
-                                    [
-                                        dcc.Markdown(
-                                            """
+                                                style=mkstyle_ins,
+                                            )
+                                        ],
+                                        style=mkstyle_ous,
+                                    ),
+                                    html.Div(
+                                        [
+                                            dcc.Markdown(
+                                                """
                                 ### How to Use Application.       
                                 - Click 2010s legend near map, 2010s scatters turn off. Click one more, Turn on.
                                 We can feel massive increase in 2010s.     
                                 - Click the year on the upper Bar graph, points on the map shows only the year.     
                                 - Click 1946 on the upper Bar graph, all data appears.   
                                     """,
-                                            style=mkstyle_ins,
-                                        )
-                                    ],
-                                    style=mkstyle_ous,
-                                ),
-                                html.Div(
-                                    [
-                                        html.Div(
-                                            [
-                                                dcc.Link(
-                                                    "Next: 数据可视化",
-                                                    href="/datavisualization",
-                                                )
-                                            ]
-                                        )
-                                    ],
-                                    style={"textAlign": "right", "marginBottom": "5%"},
-                                ),
-                            ],
-                            style={"width": "90%", "margin": "auto"},
-                        ),
-                    ]
-                ),
-            ]
-        ),
-    ]
-)
+                                                style=mkstyle_ins,
+                                            )
+                                        ],
+                                        style=mkstyle_ous,
+                                    ),
+                                    html.Div(
+                                        [
+                                            html.Div(
+                                                [
+                                                    dcc.Link(
+                                                        "Next: 数据可视化",
+                                                        href="/datavisualization",
+                                                    )
+                                                ]
+                                            )
+                                        ],
+                                        style={
+                                            "textAlign": "right",
+                                            "marginBottom": "5%",
+                                        },
+                                    ),
+                                ],
+                                style={"width": "90%", "margin": "auto"},
+                            ),
+                        ]
+                    ),
+                ]
+            ),
+        ]
+    )
+
 
 # --------------------------- Tourist by country callback ---------------------------------------------
 
 
-@app_dash.callback(
-    Output("year_tourist_rank", "children"), [Input("year_select_dd", "value")]
-)
-def year_rank_update(year_select):
-    df2 = jpvisit1[jpvisit1["year"] == year_select]
-    pivR = pd.pivot_table(df2, index=["country"], values="value", aggfunc="sum")
-    pivR = pivR.assign(year=year_select)
-    pivR = pivR.assign(country=pivR.index)
-    pivR = pivR[["country", "year", "value"]]
-    pivR = pivR.sort_values(by="value", ascending=False)
-
-    pivR = pivR[:10]
-    table = dash_table.DataTable(
-        columns=[{"name": i, "id": i} for i in pivR.columns],
-        data=pivR.to_dict("records"),
-        style_cell={
-            "height": 30,
-            "minWidth": 0,
-            "maxWidth": 180,
-            "whiteSpace": "normal",
-            "fontSize": 30,
-            "textAlign": "center",
-        },
-    )
-    return table
+@app_dash.callback(
+    Output("year_tourist_rank", "children"), [Input("year_select_dd", "value")]
+)
+def year_rank_update(year_select):
+    table = paged_table(
+        "year-rank-table",
+        ["country", "year", "value"],
+        year_rank_frame(year_select),
+        rank_top_n,
+        style_cell={
+            "height": 30,
+            "minWidth": 0,
+            "maxWidth": 180,
+            "whiteSpace": "normal",
+            "fontSize": 30,
+            "textAlign": "center",
+        },
+    )
+    return table
+
+
+@memoized_callback(
+    [Output("year-rank-table", "data"), Output("year-rank-table", "page_count")],
+    paged_table_inputs("year-rank-table"),
+    [State("year_select_dd", "value")],
+    prevent_initial_call=True,
+)
+def year_rank_page(page_current, page_size, filter_query, sort_by, year_select):
+    return table_view(
+        year_rank_frame(year_select),
+        page_current,
+        page_size,
+        filter_query,
+        sort_by,
+        name=("year_rank", year_select),
+    )
+
+
+# -------------------------------- tourist by country month callback ----------------------------------
+
+
+# 月次の棒グラフは、表示している範囲の点だけを区間ごとの最大・最小に間引いて送る
+# ズームすると relayoutData から範囲を受け取り、その範囲を細かく取り直す
+# 点数はブラウザで測った全幅のグラフの幅 (px) で、1px に 1 点まで。半分の幅のグラフはその半分
+# 幅がわからないときは DOWNSAMPLE_POINTS を使う
+downsample_points = int(os.environ.get("DOWNSAMPLE_POINTS", 800))
+tourist_graphs = ["tourist_graph", "all_tourist_graph", "country_tourist_ratio"]
+
+
+def relayout_range(relayoutData):
+    if not relayoutData:
+        return None
+    if "xaxis.range" in relayoutData:
+        return [str(v) for v in relayoutData["xaxis.range"]]
+    if "xaxis.range[0]" in relayoutData and "xaxis.range[1]" in relayoutData:
+        return [
+            str(relayoutData["xaxis.range[0]"]),
+            str(relayoutData["xaxis.range[1]"]),
+        ]
+    return None
+
+
+def minmax_indices(values, n_buckets):
+    n = len(values)
+    if n <= 2 * n_buckets:
+        return np.arange(n)
+    size = -(-n // n_buckets)
+    rows = -(-n // size)
+    highs = np.full(rows * size, -np.inf)
+    lows = np.full(rows * size, np.inf)
+    highs[:n] = np.where(np.isnan(values), -np.inf, values)
+    lows[:n] = np.where(np.isnan(values), np.inf, values)
+    starts = np.arange(rows) * size
+    picked = np.concatenate(
+        [
+            starts + highs.reshape(rows, size).argmax(axis=1),
+            starts + lows.reshape(rows, size).argmin(axis=1),
+        ]
+    )
+    return np.unique(np.minimum(picked, n - 1))
+
+
+def tourist_points(width):
+    if not width:
+        return downsample_points
+    return min(max(int(width), 200), 4000)
+
+
+def downsampled_bar(series, column, x_range, points):
+    date = series["date"]
+    lo, hi = 0, len(date)
+    if x_range is not None:
+        lo, hi = np.searchsorted(date, x_range)
+        lo, hi = max(lo - 1, 0), min(hi + 1, len(date))
+    values = series[column][lo:hi]
+    idx = minmax_indices(values, max(int(points) // 2, 1))
+    return go.Bar(x=date[lo:hi][idx], y=values[idx])
+
+
+def tourist_layout(**kwargs):
+    return go.Layout(uirevision="tourist", yaxis=dict(fixedrange=True), **kwargs)
 
 
-# -------------------------------- tourist by country month callback ----------------------------------
+# ページを開いたときに一度だけ、全幅のグラフの幅を 100px 単位で測る
+app_dash.clientside_callback(
+    """
+    function(id) {
+        var graph = document.getElementById("country_tourist_ratio");
+        var width = graph && graph.offsetWidth ? graph.offsetWidth : window.innerWidth;
+        return Math.ceil(width / 100) * 100;
+    }
+    """,
+    Output("tourist_width", "data"),
+    [Input("tourist_country_dd", "id")],
+)
 
 
-@app_dash.callback(
-    [
-        Output("tourist_graph", "figure"),
-        Output("all_tourist_graph", "figure"),
-        Output("country_tourist_ratio", "figure"),
-    ],
-    [Input("tourist_country_dd", "value")],
+@memoized_callback(
+    [Output(graph, "figure") for graph in tourist_graphs],
+    [Input("tourist_country_dd", "value"), Input("tourist_width", "data")]
+    + [Input(graph, "relayoutData") for graph in tourist_graphs],
+    key=lambda tourist_country, width, *layouts: [
+        tourist_country,
+        tourist_points(width),
+    ]
+    + [relayout_range(layout) for layout in layouts],
 )
-def tourist_graph_update(tourist_country):
-    dff = jpvisit[jpvisit["country"] == tourist_country]
-    dff.index = [i for i in range(len(dff))]
-    dfa = jpvisit[jpvisit["country"] == "総数"]
-    dfa.index = [i for i in range(len(dfa))]
+def tourist_graph_update(tourist_country, width, *layouts):
+    tourist_store = load("tourist_store")
+    dff = tourist_store[tourist_country]
+    dfa = tourist_store["総数"]
+    ranges = [relayout_range(layout) for layout in layouts]
+    points = tourist_points(width)
 
     firstG = {
-        "data": [go.Bar(x=dff["date"], y=dff["value"])],
-        "layout": go.Layout(title="Visit from {}".format(tourist_country), height=400),
+        "data": [downsampled_bar(dff, "value", ranges[0], points / 2)],
+        "layout": tourist_layout(
+            title="Visit from {}".format(tourist_country), height=400
+        ),
     }
 
     secondG = {
-        "data": [go.Bar(x=dfa["date"], y=dfa["value"])],
-        "layout": go.Layout(title="Total Tourist(by month)", height=400),
+        "data": [downsampled_bar(dfa, "value", ranges[1], points / 2)],
+        "layout": tourist_layout(title="Total Tourist(by month)", height=400),
     }
 
     thirdG = {
-        "data": [go.Bar(x=dff["date"], y=dff["value"] / dfa["value"])],
-        "layout": go.Layout(title="Tourist ratio({})".format(tourist_country)),
+        "data": [downsampled_bar(dff, "ratio", ranges[2], points)],
+        "layout": tourist_layout(title="Tourist ratio({})".format(tourist_country)),
     }
 
     return firstG, secondG, thirdG
@@ -657,105 +1625,48 @@ def tourist_graph_update(tourist_country):
 # -------------------------------
 
 
-@app_dash.callback(
-    [
-        Output("kyoto-hotelmap-yearcallback", "figure"),
-        Output("year-number", "children"),
+hotel_map_outputs = [
+    Output("kyoto-hotelmap-yearcallback", "figure"),
+    Output("year-number", "children"),
+]
+hotel_map_inputs = [
+    Input("kyoto-hotel-bar", "clickData"),
+    Input("kyoto-hotelmap-yearcallback", "relayoutData"),
+]
+
+
+# クリックデータのうち、結果を決めるのは年だけ。地図の表示範囲は格子の番号にまとめる
+@memoized_callback(
+    hotel_map_outputs,
+    hotel_map_inputs,
+    key=lambda clickData, relayoutData: [
+        clickData["points"][0]["x"],
+        hotel_map_view(relayoutData),
     ],
-    [Input("kyoto-hotel-bar", "clickData")],
 )
-def update_map(clickData):
+def update_map(clickData, relayoutData):
+    df_kyoto_hotels_groupby = load("df_kyoto_hotels_groupby")
+    hotels_by_age = load("hotels_by_age")
     data_x = clickData["points"][0]["x"]
-    dff = df_kyoto_hotels[df_kyoto_hotels["year"] == data_x]
+    view = hotel_map_view(relayoutData)
     dff_amount = df_kyoto_hotels_groupby[df_kyoto_hotels_groupby["year"] == data_x]
-    if data_x == "all":
-        return (
-            {
-                "data": [
-                    go.Scattermapbox(
-                        lat=df_kyoto_hotels[df_kyoto_hotels["age"] == i]["ido"],
-                        lon=df_kyoto_hotels[df_kyoto_hotels["age"] == i]["keido"],
-                        mode="markers",
-                        marker=dict(size=9),
-                        text=df_kyoto_hotels[df_kyoto_hotels["age"] == i]["hotel_name"],
-                        name=str(i),
-                    )
-                    for i in df_kyoto_hotels["age"].unique()
-                ],
-                "layout": go.Layout(
-                    autosize=True,
-                    hovermode="closest",
-                    mapbox=dict(
-                        accesstoken=mapbox_accesstoken,
-                        center=dict(
-                            lat=np.mean(df_kyoto_hotels["ido"]),
-                            lon=np.mean(df_kyoto_hotels["keido"]),
-                        ),
-                        pitch=90,
-                        zoom=12,
-                    ),
-                    height=600,
-                ),
-            },
-            "Number of Kyoto hotels (2018/12)： {}".format(len(df_kyoto_hotels)),
-        )
-    elif data_x == 1946:
+    if data_x == "all" or data_x == 1946:
         return (
             {
-                "data": [
-                    go.Scattermapbox(
-                        lat=df_kyoto_hotels[df_kyoto_hotels["age"] == i]["ido"],
-                        lon=df_kyoto_hotels[df_kyoto_hotels["age"] == i]["keido"],
-                        mode="markers",
-                        marker=dict(size=9),
-                        text=df_kyoto_hotels[df_kyoto_hotels["age"] == i]["hotel_name"],
-                        name=str(i),
-                    )
-                    for i in df_kyoto_hotels["age"].unique()
-                ],
-                "layout": go.Layout(
-                    autosize=True,
-                    hovermode="closest",
-                    mapbox=dict(
-                        accesstoken=mapbox_accesstoken,
-                        center=dict(
-                            lat=np.mean(df_kyoto_hotels["ido"]),
-                            lon=np.mean(df_kyoto_hotels["keido"]),
-                        ),
-                        pitch=90,
-                        zoom=12,
-                    ),
-                    height=600,
-                ),
+                "data": hotel_traces(hotels_by_age, hotels_by_age["labels"], view=view),
+                "layout": hotel_map_layout(),
             },
-            "Number of Kyoto hotels (2018/12)： {}".format(len(df_kyoto_hotels)),
+            "Number of Kyoto hotels (2018/12)： {}".format(
+                len(load("df_kyoto_hotels"))
+            ),
         )
     else:
         return (
             {
-                "data": [
-                    go.Scattermapbox(
-                        lat=dff["ido"],
-                        lon=dff["keido"],
-                        mode="markers",
-                        marker=dict(size=9),
-                        text=dff["hotel_name"],
-                    )
-                ],
-                "layout": go.Layout(
-                    autosize=True,
-                    hovermode="closest",
-                    mapbox=dict(
-                        accesstoken=mapbox_accesstoken,
-                        center=dict(
-                            lat=np.mean(df_kyoto_hotels["ido"]),
-                            lon=np.mean(df_kyoto_hotels["keido"]),
-                        ),
-                        pitch=90,
-                        zoom=12,
-                    ),
-                    height=600,
+                "data": hotel_traces(
+                    load("hotels_by_year"), [data_x], named=False, view=view
                 ),
+                "layout": hotel_map_layout(),
             },
             "Number of hotels built in {}: {}".format(
                 data_x, dff_amount["count"].values[0]
@@ -763,6 +1674,35 @@ def update_map(clickData):
         )
 
 
+# 地図をクリックした場所の近くにあるホテルを、近い順に表示する
+hotel_near_radius_km = 0.5
+hotel_near_limit = 10
+
+
+@app_dash.callback(
+    Output("hotels-near-click", "children"),
+    [Input("kyoto-hotelmap-yearcallback", "clickData")],
+    prevent_initial_call=True,
+)
+def show_hotels_near_click(clickData):
+    point = clickData["points"][0]
+    rows, distance = hotels_near(
+        load("hotel_grid"), point["lat"], point["lon"], hotel_near_radius_km
+    )
+    names = load("df_kyoto_hotels")["hotel_name"].to_numpy()[rows[:hotel_near_limit]]
+    return [
+        html.H4(
+            "Hotels within {:.0f} m: {}".format(hotel_near_radius_km * 1000, len(rows))
+        ),
+        html.Ul(
+            [
+                html.Li("{} ({:.0f} m)".format(name, km * 1000))
+                for name, km in zip(names, distance[:hotel_near_limit])
+            ]
+        ),
+    ]
+
+
 # ------------------- About Data Visualization -------------------------------------
 # Dashについて話す前に、そもそものデータビジュアライゼーションについて話します。
 # ここは頑張らずにサンプルデータを利用する。 iris, gapminder,
@@ -816,7 +1756,8 @@ def update_markdown(n_clicks):
         )
 
 
-iris = plotly.data.iris()
+lazy("iris", plotly.data.iris)
+iris_page_size = 15
 
 datavisualization_human = html.Div(
     [
@@ -837,19 +1778,25 @@ datavisualization_human = html.Div(
 )
 
 
-@app_dash.callback(
-    Output("showdata_for_humans", "children"), [Input("table_to_chart", "n_clicks")]
+# 結果はクリック回数の偶奇だけで決まる
+@memoized_callback(
+    Output("showdata_for_humans", "children"),
+    [Input("table_to_chart", "n_clicks")],
+    key=lambda n_clicks: n_clicks % 2,
 )
 def change_table_to_chart(n_clicks):
+    iris = load("iris")
     if n_clicks % 2 == 0:
         return html.Div(
             [
                 html.H2(
                     "Table is difficult to understand.", style={"textAlign": "center"}
                 ),
-                dash_table.DataTable(
-                    columns=[{"id": i, "name": i} for i in iris.columns],
-                    data=iris.to_dict("records"),
+                paged_table(
+                    "iris-table",
+                    iris.columns,
+                    iris,
+                    iris_page_size,
                     style_cell={"textAlign": "center", "fontSize": 25},
                 ),
             ]
@@ -874,66 +1821,194 @@ def change_table_to_chart(n_clicks):
         )
 
 
-gapminder = plotly.data.gapminder()
-gapminder5 = gapminder[
-    gapminder["country"].isin(
-        ["Canada", "Switzerland", "Denmark", "United States", "Australia"]
+@memoized_callback(
+    [Output("iris-table", "data"), Output("iris-table", "page_count")],
+    paged_table_inputs("iris-table"),
+    prevent_initial_call=True,
+)
+def iris_table_page(page_current, page_size, filter_query, sort_by):
+    return table_view(
+        load("iris"), page_current, page_size, filter_query, sort_by, name="iris"
     )
-]
 
 
-interactive_visualization = html.Div(
-    [
-        head_title("关于数据可视化3"),
-        html.Div(
-            [
-                html.H2(
-                    "Normal Visualization(with using gapminder data)",
-                    style={"textAlign": "center"},
-                ),
-                html.Button("change button", id="normal_button", n_clicks=0),
-                html.Div(id="normal_visualization"),
-                html.Div(
-                    [
-                        html.H2(
-                            "Interactive Visualization", style={"textAlign": "center"}
-                        ),
-                        html.Button(
-                            "change button", id="interactive_button", n_clicks=0
-                        ),
-                        html.Div(id="interactive_viz"),
-                        dcc.Checklist(
-                            id="interactive_checklist",
-                            options=[
-                                {"label": i, "value": i}
-                                for i in gapminder.country.unique()
-                            ],
-                            labelStyle={"display": "inline-block"},
-                            value=[
-                                "Canada",
-                                "Switzerland",
-                                "Denmark",
-                                "United States",
-                                "Australia",
-                            ],
-                        ),
-                    ]
-                ),
-            ],
-            style={"margin": "5%"},
-        ),
-        html.Div(
-            [dcc.Link("Next: 关于数据可视化4", href="/visualization_tools")],
-            style={"textAlign": "right", "margin": "5%"},
-        ),
-    ]
+lazy("gapminder", plotly.data.gapminder)
+
+
+# gapminder は年・国・大陸ごとに並べ替えたフレームと区切り位置を一度だけ作っておき、
+# コールバックでは全体をマスクせずに必要な区間だけをスライスで取り出す
+def build_frame_index(df, key):
+    codes, labels = pd.factorize(df[key], sort=True)
+    order = np.argsort(codes, kind="stable")
+    offsets = np.concatenate(
+        [[0], np.cumsum(np.bincount(codes, minlength=len(labels)))]
+    )
+    return {
+        "labels": list(labels),
+        "positions": {label: i for i, label in enumerate(labels)},
+        "offsets": offsets,
+        "frame": df.iloc[order],
+    }
+
+
+lazy(
+    "gapminder_index",
+    lambda: {
+        key: build_frame_index(load("gapminder"), key)
+        for key in ("year", "country", "continent")
+    },
 )
 
 
-@app_dash.callback(
-    Output("normal_visualization", "children"), [Input("normal_button", "n_clicks")]
+def gapminder_labels(key):
+    return load("gapminder_index")[key]["labels"]
+
+
+def gapminder_query(key, values):
+    index = load("gapminder_index")[key]
+    if not isinstance(values, (list, tuple, set)):
+        values = [values]
+    offsets = index["offsets"]
+    positions = sorted(
+        index["positions"][value]
+        for value in set(values)
+        if value in index["positions"]
+    )
+    if len(positions) == 1:
+        i = positions[0]
+        return index["frame"].iloc[offsets[i] : offsets[i + 1]]
+    rows = [np.arange(offsets[i], offsets[i + 1]) for i in positions]
+    return index["frame"].iloc[np.concatenate(rows) if rows else []]
+
+
+lazy(
+    "gapminder5",
+    lambda: gapminder_query(
+        "country", ["Canada", "Switzerland", "Denmark", "United States", "Australia"]
+    ),
+)
+
+
+@lazy("interactive_visualization")
+def interactive_visualization_layout():
+    return html.Div(
+        [
+            head_title("关于数据可视化3"),
+            html.Div(
+                [
+                    html.H2(
+                        "Normal Visualization(with using gapminder data)",
+                        style={"textAlign": "center"},
+                    ),
+                    html.Button("change button", id="normal_button", n_clicks=0),
+                    html.Div(id="normal_visualization"),
+                    html.Div(
+                        [
+                            html.H2(
+                                "Interactive Visualization",
+                                style={"textAlign": "center"},
+                            ),
+                            html.Button(
+                                "change button", id="interactive_button", n_clicks=0
+                            ),
+                            html.Div(id="interactive_viz"),
+                            html.Button(
+                                "Select all countries",
+                                id="interactive_select_all",
+                                n_clicks=0,
+                            ),
+                            html.Button("Clear", id="interactive_clear", n_clicks=0),
+                            dcc.Checklist(
+                                id="interactive_checklist",
+                                options=[
+                                    {"label": i, "value": i}
+                                    for i in gapminder_labels("country")
+                                ],
+                                labelStyle={"display": "inline-block"},
+                                value=[
+                                    "Canada",
+                                    "Switzerland",
+                                    "Denmark",
+                                    "United States",
+                                    "Australia",
+                                ],
+                            ),
+                            dcc.Store(id="interactive_sent"),
+                            dcc.Store(id="interactive_added"),
+                        ]
+                    ),
+                ],
+                style={"margin": "5%"},
+            ),
+            html.Div(
+                [dcc.Link("Next: 关于数据可视化4", href="/visualization_tools")],
+                style={"textAlign": "right", "margin": "5%"},
+            ),
+        ]
+    )
+
+
+# アニメーションのフレームには、フレームごとに変わる値（x, y, marker.size など）だけを残す
+# 全フレームで同じ国名や大陸、hovertext は最初のトレースで一度だけ送る
+# plotly はフレームのデータを今のトレースに重ねるので、表示は変わらない
+def flatten_trace(trace, prefix=()):
+    items = {}
+    for key, value in trace.items():
+        if isinstance(value, dict):
+            items.update(flatten_trace(value, prefix + (key,)))
+        else:
+            items[prefix + (key,)] = value
+    return items
+
+
+def same_value(a, b):
+    sequences = (list, tuple, np.ndarray)
+    if isinstance(a, sequences) or isinstance(b, sequences):
+        return (
+            a is not None
+            and b is not None
+            and len(a) == len(b)
+            and np.array_equal(np.asarray(a, dtype=object), np.asarray(b, dtype=object))
+        )
+    return a == b
+
+
+def compact_frames(fig):
+    fig = fig.to_dict()
+    frames = fig.get("frames", [])
+    if len(frames) < 2:
+        return fig
+    for i in range(len(frames[0]["data"])):
+        traces = [flatten_trace(frame["data"][i]) for frame in frames]
+        first = traces[0]
+        paths = set().union(*traces)
+        varying = {
+            path
+            for path in paths
+            if any(
+                path not in trace or not same_value(trace[path], first.get(path))
+                for trace in traces
+            )
+        }
+        for frame, trace in zip(frames, traces):
+            compact = {}
+            for path in sorted(varying & set(trace)):
+                node = compact
+                for key in path[:-1]:
+                    node = node.setdefault(key, {})
+                node[path[-1]] = trace[path]
+            frame["data"][i] = compact
+    return fig
+
+
+@memoized_callback(
+    Output("normal_visualization", "children"),
+    [Input("normal_button", "n_clicks")],
+    key=lambda n_clicks: n_clicks % 2,
 )
 def update_to_normal(n_clicks):
+    gapminder = load("gapminder")
+    gapminder5 = load("gapminder5")
     if n_clicks % 2 == 0:
         return dcc.Graph(
             figure=px.line(
@@ -956,43 +2031,139 @@ def update_to_normal(n_clicks):
         )
 
 
-# 全部の国が選べるボタンも欲しい。
+# 全ての国の折れ線を一度だけ作っておき、サーバーからは選ばれている国の線だけを送る
+# チェックリストで国を足したときは、まだ送っていない国の線だけを追加で送り、
+# 外したときはブラウザ側で visible を書き換えるだけにする
+lazy(
+    "gapminder_lines",
+    lambda: px.line(
+        load("gapminder"),
+        x="year",
+        y="gdpPercap",
+        color="country",
+        title="Interactive Visualization",
+    ).to_dict(),
+)
+lazy(
+    "gapminder_line_traces",
+    lambda: {trace["name"]: trace for trace in load("gapminder_lines")["data"]},
+)
+
+
+# 全部の国でまとめて色を付けると 10 色のパレットが一周して同じ色が並ぶので、
+# グラフに送った順番で色を付けなおす
+def colored_line_traces(countries, start=0):
+    traces = load("gapminder_line_traces")
+    palette = px.colors.qualitative.Plotly
+    return [
+        dict(
+            traces[country],
+            line=dict(
+                traces[country]["line"], color=palette[(start + i) % len(palette)]
+            ),
+        )
+        for i, country in enumerate(countries)
+    ]
 
 
-@app_dash.callback(
+@memoized_callback(
     Output("interactive_viz", "children"),
-    [Input("interactive_button", "n_clicks"), Input("interactive_checklist", "value")],
+    [Input("interactive_button", "n_clicks")],
+    [State("interactive_checklist", "value")],
+    key=lambda n_clicks, country_list: (
+        [0, sorted(country_list or [])] if n_clicks % 2 == 0 else [1]
+    ),
 )
 def update_interactive(n_clicks, country_list):
-    gapp = gapminder[gapminder["country"].isin(country_list)]
+    gapminder = load("gapminder")
     if n_clicks % 2 == 0:
-        return dcc.Graph(
-            figure=px.line(
-                gapp,
-                x="year",
-                y="gdpPercap",
-                color="country",
-                title="Interactive Visualization",
-            )
-        )
+        lines = load("gapminder_lines")
+        selected = set(country_list or [])
+        countries = [t["name"] for t in lines["data"] if t["name"] in selected]
+        data = colored_line_traces(countries)
+        return dcc.Graph(id="interactive_line", figure=dict(lines, data=data))
     else:
         return dcc.Graph(
-            figure=px.scatter(
-                gapminder,
-                x="gdpPercap",
-                y="lifeExp",
-                size="pop",
-                color="continent",
-                hover_name="country",
-                animation_frame="year",
-                size_max=45,
-                range_x=[100, 100000],
-                range_y=[30, 90],
-                log_x=True,
+            figure=compact_frames(
+                px.scatter(
+                    gapminder,
+                    x="gdpPercap",
+                    y="lifeExp",
+                    size="pop",
+                    color="continent",
+                    hover_name="country",
+                    animation_frame="year",
+                    render_mode=render_mode(
+                        np.diff(load("gapminder_index")["year"]["offsets"]).max()
+                    ),
+                    size_max=45,
+                    range_x=[100, 100000],
+                    range_y=[30, 90],
+                    log_x=True,
+                )
             )
         )
 
 
+# interactive_sent は今の折れ線グラフに送ってある国の一覧
+# ボタンで描き直したときは、update_interactive が送る国 (選択中の国) に戻す
+@app_dash.callback(
+    [Output("interactive_added", "data"), Output("interactive_sent", "data")],
+    [Input("interactive_button", "n_clicks"), Input("interactive_checklist", "value")],
+    [State("interactive_sent", "data")],
+)
+def add_interactive_traces(n_clicks, country_list, sent):
+    triggered = dash.callback_context.triggered[0]["prop_id"]
+    if triggered in (".", "interactive_button.n_clicks"):
+        return [], list(country_list or []) if n_clicks % 2 == 0 else []
+    sent = sent or []
+    missing = [country for country in country_list or [] if country not in set(sent)]
+    if not missing:
+        raise PreventUpdate
+    traces = load("gapminder_line_traces")
+    missing = [country for country in missing if country in traces]
+    return colored_line_traces(missing, len(sent)), sent + missing
+
+
+app_dash.clientside_callback(
+    """
+    function(countries, added, figure) {
+        if (!figure) {
+            return window.dash_clientside.no_update;
+        }
+        var names = new Set(figure.data.map(function(trace) { return trace.name; }));
+        var data = figure.data.concat((added || []).filter(function(trace) {
+            return !names.has(trace.name);
+        }));
+        var selected = new Set(countries || []);
+        return Object.assign({}, figure, {
+            data: data.map(function(trace) {
+                return Object.assign({}, trace, {visible: selected.has(trace.name)});
+            })
+        });
+    }
+    """,
+    Output("interactive_line", "figure"),
+    [Input("interactive_checklist", "value"), Input("interactive_added", "data")],
+    [State("interactive_line", "figure")],
+)
+
+
+# 全部の国を選ぶボタンと、選択を外すボタン
+@app_dash.callback(
+    Output("interactive_checklist", "value"),
+    [
+        Input("interactive_select_all", "n_clicks"),
+        Input("interactive_clear", "n_clicks"),
+    ],
+    prevent_initial_call=True,
+)
+def select_all_countries(select_all, clear):
+    if dash.callback_context.triggered[0]["prop_id"].startswith("interactive_clear"):
+        return []
+    return gapminder_labels("country")
+
+
 visualization_tools = html.Div(
     [
         head_title("关于数据可视化4"),
@@ -1300,11 +2471,11 @@ dash_graphs = html.Div(
 # マークダウン内のコメントアウトの処理
 
 # グラフモジュールによる違いを見せるコールバック
-@app_dash.callback(
+@memoized_callback(
     Output("graph_by_module", "children"), [Input("graphs_radio", "value")]
 )
 def update_by_graph_module(module_name):
-    gapminder2007 = gapminder[gapminder["year"] == 2007]
+    gapminder2007 = gapminder_query("year", 2007)
     if module_name == "dash":
         return html.Div(
             [
@@ -1423,62 +2594,150 @@ def update_by_graph_module(module_name):
 
 # Components
 params = ["Weight", "Torque", "Width", "Height"]
+editing_table_rows = [
+    dict(id=i, Model=i, **{param: 0 for param in params}) for i in range(1, 5)
+]
+
 
 # ####Cytoscape Data Preprocessing
+# フォロー関係は整数の節点番号に置き換え、CSR 形式 (区切り位置と隣接の配列) で持つ
+# Cytoscape の要素 (dict) は、コールバックで必要になった分だけ作る
+def build_adjacency(keys, others, n_nodes):
+    order = np.argsort(keys, kind="stable")
+    offsets = np.zeros(n_nodes + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(keys, minlength=n_nodes))
+    return {"offsets": offsets, "edges": order, "neighbors": others[order]}
+
+
+def build_cyto_graph(ids, sources, targets):
+    return {
+        "ids": np.asarray(ids, dtype=object),
+        "index": {node_id: i for i, node_id in enumerate(ids)},
+        "sources": sources,
+        "targets": targets,
+        # user -> users they are following / user -> their followers
+        "following": build_adjacency(sources, targets, len(ids)),
+        "followers": build_adjacency(targets, sources, len(ids)),
+        "genesis": 0,
+    }
+
 
-with open("assets/cyto_sample.txt", "r") as f:
-    network_data = f.read().split("\n")
+# 空白区切りの辺リスト (.gz も可) を少しずつ読み、節点番号の配列にしていく
+# 節点番号は最初に現れた順に振る。元のテキストを丸ごとメモリに載せない
+edge_chunk_lines = 1 << 16
 
-edges = network_data[:750]
-nodes = set()
 
-following_node_di = {}  # user id -> list of users they are following
-following_edges_di = {}  # user id -> list of cy edges starting from user id
+def read_edge_list(path, chunk_lines=edge_chunk_lines):
+    index = {}
+    chunks = []
+    reader = pd.read_csv(
+        path,
+        sep=r"\s+",
+        header=None,
+        names=["source", "target"],
+        dtype=str,
+        on_bad_lines="skip",
+        chunksize=chunk_lines,
+    )
+    for chunk in reader:
+        chunk = chunk.dropna()
+        endpoints = np.empty(2 * len(chunk), dtype=object)
+        endpoints[0::2] = chunk["source"].to_numpy()
+        endpoints[1::2] = chunk["target"].to_numpy()
+        codes, uniques = pd.factorize(endpoints)
+        mapping = np.array(
+            [index.setdefault(node_id, len(index)) for node_id in uniques],
+            dtype=np.int64,
+        )
+        chunks.append(mapping[codes])
+    codes = np.concatenate(chunks) if chunks else np.empty(0, dtype=np.int64)
+    return np.array(list(index), dtype=object), codes[0::2], codes[1::2]
+
+
+# 作った隣接配列は .npz に保存しておける (python application.py --build-assets)
+# 辺リストより古い .npz は使わない
+def edge_index_path(path):
+    if path.endswith(".gz"):
+        path = path[: -len(".gz")]
+    return os.path.splitext(path)[0] + ".npz"
+
+
+def save_edge_index(graph, npz_path):
+    arrays = {
+        "ids": np.array(graph["ids"], dtype=str),
+        "sources": graph["sources"],
+        "targets": graph["targets"],
+    }
+    for direction in ("following", "followers"):
+        for key, values in graph[direction].items():
+            arrays["{}_{}".format(direction, key)] = values
+    np.savez(npz_path, **arrays)
+
+
+def load_edge_index(npz_path):
+    with np.load(npz_path, allow_pickle=False) as npz:
+        ids = npz["ids"].astype(object)
+        graph = {
+            "ids": ids,
+            "index": {node_id: i for i, node_id in enumerate(ids)},
+            "sources": npz["sources"],
+            "targets": npz["targets"],
+            "genesis": 0,
+        }
+        for direction in ("following", "followers"):
+            graph[direction] = {
+                key: npz["{}_{}".format(direction, key)]
+                for key in ("offsets", "edges", "neighbors")
+            }
+    return graph
 
-followers_node_di = {}  # user id -> list of followers (cy_node format)
-followers_edges_di = {}  # user id -> list of cy edges ending at user id
 
-cy_edges = []
-cy_nodes = []
+def read_edge_graph(path):
+    npz_path = edge_index_path(path)
+    if (
+        not os.path.exists(npz_path)
+        or os.path.getmtime(npz_path) < os.path.getmtime(path)
+    ):
+        return build_cyto_graph(*read_edge_list(path))
+    return load_edge_index(npz_path)
 
-for edge in edges:
-    if " " not in edge:
-        continue
 
-    source, target = edge.split(" ")
+cyto_edges_path = os.environ.get("CYTO_EDGES", "assets/cyto_sample.txt")
 
-    cy_edge = {"data": {"id": source + target, "source": source, "target": target}}
-    cy_target = {"data": {"id": target, "label": "User #" + str(target[-5:])}}
-    cy_source = {"data": {"id": source, "label": "User #" + str(source[-5:])}}
 
-    if source not in nodes:
-        nodes.add(source)
-        cy_nodes.append(cy_source)
-    if target not in nodes:
-        nodes.add(target)
-        cy_nodes.append(cy_target)
+def cy_node(graph, node, classes=None, position=None):
+    node_id = graph["ids"][node]
+    element = {"data": {"id": node_id, "label": "User #" + node_id[-5:]}}
+    if classes:
+        element["classes"] = classes
+    if position is not None:
+        element["position"] = {"x": float(position[0]), "y": float(position[1])}
+    return element
 
-    # Process dictionary of following
-    if not following_node_di.get(source):
-        following_node_di[source] = []
-    if not following_edges_di.get(source):
-        following_edges_di[source] = []
 
-    following_node_di[source].append(cy_target)
-    following_edges_di[source].append(cy_edge)
+def cy_edge(graph, edge, classes=None):
+    source = graph["ids"][graph["sources"][edge]]
+    target = graph["ids"][graph["targets"][edge]]
+    element = {"data": {"id": source + target, "source": source, "target": target}}
+    if classes:
+        element["classes"] = classes
+    return element
 
-    # Process dictionary of followers
-    if not followers_node_di.get(target):
-        followers_node_di[target] = []
-    if not followers_edges_di.get(target):
-        followers_edges_di[target] = []
 
-    followers_node_di[target].append(cy_source)
-    followers_edges_di[target].append(cy_edge)
+def adjacent(graph, direction, node):
+    adjacency = graph[direction]
+    sl = slice(adjacency["offsets"][node], adjacency["offsets"][node + 1])
+    return adjacency["neighbors"][sl], adjacency["edges"][sl]
+
+
+@lazy("cyto_graph")
+def load_cyto_graph():
+    graph = read_edge_graph(cyto_edges_path)
+    graph["default_elements"] = [
+        cy_node(graph, graph["genesis"], "genesis", position=(0, 0))
+    ]
+    return graph
 
-genesis_node = cy_nodes[0]
-genesis_node["classes"] = "genesis"
-default_elements = [genesis_node]
 
 default_stylesheet = [
     {"selector": "node", "style": {"opacity": 0.65, "z-index": 9999}},
@@ -1565,37 +2824,54 @@ styles = {
     "tab": {"height": "calc(98vh - 80px)"},
 }
 
-fjson = open("assets/mol2d.json", "r")
-moljson = json.load(fjson)
-fjson.close()
 
-# ########dash_components Layout
+@lazy("moljson")
+def load_moljson():
+    fjson = open("assets/mol2d.json", "r")
+    moljson = json.load(fjson)
+    fjson.close()
+    return moljson
 
-dash_components = html.Div(
-    [
-        head_title("Components"),
-        html.Div(
-            [
-                html.Div(
-                    [
-                        dcc.Markdown(
-                            """
+
+# ########dash_components Layout
+@lazy("dash_components")
+def dash_components_layout():
+    gapminder = load("gapminder")
+    daq = load("dash_daq")
+    dash_canvas = load("dash_canvas")
+    dashbio = load("dash_bio")
+    filename = load("canvas_image")
+    moljson = load("moljson")
+    default_elements = load("cyto_graph")["default_elements"]
+    return html.Div(
+        [
+            head_title("Components"),
+            html.Div(
+                [
+                    html.Div(
+                        [
+                            dcc.Markdown(
+                                """
             Dash has 7 components ready to use.
             Today I will show you some of these.
         """,
-                            style=mkstyle_ins,
-                        )
-                    ],
-                    style=mkstyle_ous,
-                ),
-                html.Div(
-                    [html.H2("dash_html_components", style={"textAlign": "center"})],
-                    style={"backgroundColor": "#fbffb9"},
-                ),
-                html.Div(
-                    [
-                        dcc.Markdown(
-                            """
+                                style=mkstyle_ins,
+                            )
+                        ],
+                        style=mkstyle_ous,
+                    ),
+                    html.Div(
+                        [
+                            html.H2(
+                                "dash_html_components", style={"textAlign": "center"}
+                            )
+                        ],
+                        style={"backgroundColor": "#fbffb9"},
+                    ),
+                    html.Div(
+                        [
+                            dcc.Markdown(
+                                """
             Dash_html_components provide HTML Tags as Python Classes.     
                  
             if you want to write       
@@ -1614,363 +2890,406 @@ dash_components = html.Div(
             Covers all HTML tags? Off Cource!!
 
         """,
-                            style=mkstyle_ins,
-                        )
-                    ],
-                    style=mkstyle_ous,
-                ),
-                html.Div(
-                    [
-                        html.A(
-                            "Dash HTML Components Document",
-                            href="https://dash.plot.ly/dash-html-components",
-                        )
-                    ],
-                    style={"textAlign": "center"},
-                ),
-                html.Div(
-                    [html.H2("Dash_Core_Components", style={"textAlign": "center"})],
-                    style={"backgroundColor": "#fbffb9"},
-                ),
-                html.Div(
-                    [
-                        dcc.Markdown(
-                            """
+                                style=mkstyle_ins,
+                            )
+                        ],
+                        style=mkstyle_ous,
+                    ),
+                    html.Div(
+                        [
+                            html.A(
+                                "Dash HTML Components Document",
+                                href="https://dash.plot.ly/dash-html-components",
+                            )
+                        ],
+                        style={"textAlign": "center"},
+                    ),
+                    html.Div(
+                        [
+                            html.H2(
+                                "Dash_Core_Components", style={"textAlign": "center"}
+                            )
+                        ],
+                        style={"backgroundColor": "#fbffb9"},
+                    ),
+                    html.Div(
+                        [
+                            dcc.Markdown(
+                                """
             Dash_Core_Components provides components like sliders, dropdowns, graphs and more.
             Many conponents fires callback. And application gets interactive.
         """,
-                            style=mkstyle_ins,
-                        )
-                    ],
-                    style=mkstyle_ous,
-                ),
-                html.Div(
-                    [
-                        html.Div(
-                            [
-                                html.P("X axis value: ", style={"fontSize": 25}),
-                                dcc.Dropdown(
-                                    id="dcc_dd_x",
-                                    options=[
-                                        {"label": i, "value": i}
-                                        for i in gapminder.columns[3:6]
-                                    ],
-                                    value="lifeExp",
-                                ),
-                            ],
-                            style={"width": "49%", "float": "left"},
-                        ),
-                        html.Div(
-                            [
-                                html.P("Y axis value: ", style={"fontSize": 25}),
-                                dcc.Dropdown(
-                                    id="dcc_dd_y",
-                                    options=[
-                                        {"label": i, "value": i}
-                                        for i in gapminder.columns[3:6]
-                                    ],
-                                    value="pop",
-                                ),
-                            ],
-                            style={"width": "49%", "display": "inline-block"},
-                        ),
-                        html.Div(id="show_dccs_graph"),
-                        html.Div(
-                            [
-                                html.A(
-                                    "Dash Core Components Document",
-                                    href="https://dash.plot.ly/dash-core-components",
-                                )
-                            ],
-                            style={"textAlign": "center"},
-                        ),
-                        # The reason is not clear but cannot be displayed...(RangeSlider)
-                        # Try to add RangeSlider Later///
-                    ]
-                ),
-                html.Div(
-                    [
-                        html.Div(
-                            [html.H2("Dash Table", style={"textAlign": "center"})],
-                            style={"backgroundColor": "#fbffb9"},
-                        ),
-                        html.Div(
-                            [
-                                dcc.Markdown(
-                                    """
+                                style=mkstyle_ins,
+                            )
+                        ],
+                        style=mkstyle_ous,
+                    ),
+                    html.Div(
+                        [
+                            html.Div(
+                                [
+                                    html.P("X axis value: ", style={"fontSize": 25}),
+                                    dcc.Dropdown(
+                                        id="dcc_dd_x",
+                                        options=[
+                                            {"label": i, "value": i}
+                                            for i in gapminder.columns[3:6]
+                                        ],
+                                        value="lifeExp",
+                                    ),
+                                ],
+                                style={"width": "49%", "float": "left"},
+                            ),
+                            html.Div(
+                                [
+                                    html.P("Y axis value: ", style={"fontSize": 25}),
+                                    dcc.Dropdown(
+                                        id="dcc_dd_y",
+                                        options=[
+                                            {"label": i, "value": i}
+                                            for i in gapminder.columns[3:6]
+                                        ],
+                                        value="pop",
+                                    ),
+                                ],
+                                style={"width": "49%", "display": "inline-block"},
+                            ),
+                            html.Div(id="show_dccs_graph"),
+                            html.Div(
+                                [
+                                    html.A(
+                                        "Dash Core Components Document",
+                                        href="https://dash.plot.ly/dash-core-components",
+                                    )
+                                ],
+                                style={"textAlign": "center"},
+                            ),
+                            # The reason is not clear but cannot be displayed...(RangeSlider)
+                            # Try to add RangeSlider Later///
+                        ]
+                    ),
+                    html.Div(
+                        [
+                            html.Div(
+                                [html.H2("Dash Table", style={"textAlign": "center"})],
+                                style={"backgroundColor": "#fbffb9"},
+                            ),
+                            html.Div(
+                                [
+                                    dcc.Markdown(
+                                        """
                 - Dash Datatable is interactive table. This can be use like Excel.
                 - I will show you how the graph changes as I enter numbers in the table. 
                 - You can create applications that can be used by drag and drop data with dash core components.  
             """,
-                                    style=mkstyle_ins,
-                                )
-                            ],
-                            style=mkstyle_ous,
-                        ),
-                        html.Div(
-                            [
-                                dash_table.DataTable(
-                                    id="table-editing-simple",
-                                    columns=(
-                                        [{"id": "Model", "name": "Model"}]
-                                        + [{"id": p, "name": p} for p in params]
+                                        style=mkstyle_ins,
+                                    )
+                                ],
+                                style=mkstyle_ous,
+                            ),
+                            html.Div(
+                                [
+                                    dash_table.DataTable(
+                                        id="table-editing-simple",
+                                        columns=(
+                                            [{"id": "Model", "name": "Model"}]
+                                            + [{"id": p, "name": p} for p in params]
+                                        ),
+                                        data=editing_table_rows,
+                                        style_cell={
+                                            "fontSize": 25,
+                                            "textAlign": "center",
+                                        },
+                                        editable=True,
+                                        filter_action="custom",
+                                        filter_query="",
+                                        sort_action="custom",
+                                        sort_mode="multi",
+                                        sort_by=[],
                                     ),
-                                    data=[
-                                        dict(Model=i, **{param: 0 for param in params})
-                                        for i in range(1, 5)
-                                    ],
-                                    style_cell={"fontSize": 25, "textAlign": "center"},
-                                    editable=True,
-                                ),
-                                dcc.Graph(id="table-editing-simple-output"),
-                            ]
-                        ),
-                        html.Div(
-                            [
-                                html.A(
-                                    "Dash DataTable Document",
-                                    href="https://dash.plot.ly/datatable",
-                                )
-                            ],
-                            style={"textAlign": "center"},
-                        ),
-                    ]
-                ),
-                # dash_daq
-                html.Div(
-                    [html.H2("Dash Daq", style={"textAlign": "center"})],
-                    style={"backgroundColor": "#fbffb9"},
-                ),
-                html.Div(
-                    [
-                        dcc.Markdown(
-                            """
+                                    dcc.Store(
+                                        id="table-editing-simple-store",
+                                        data=editing_table_rows,
+                                    ),
+                                    dcc.Graph(id="table-editing-simple-output"),
+                                ]
+                            ),
+                            html.Div(
+                                [
+                                    html.A(
+                                        "Dash DataTable Document",
+                                        href="https://dash.plot.ly/datatable",
+                                    )
+                                ],
+                                style={"textAlign": "center"},
+                            ),
+                        ]
+                    ),
+                    # dash_daq
+                    html.Div(
+                        [html.H2("Dash Daq", style={"textAlign": "center"})],
+                        style={"backgroundColor": "#fbffb9"},
+                    ),
+                    html.Div(
+                        [
+                            dcc.Markdown(
+                                """
             - Dash Daq is for Data aquisition. 
             - Here I make fake real time application with numpy random modules.
             - Push the button!!
         """,
-                            style=mkstyle_ins,
-                        )
-                    ],
-                    style=mkstyle_ous,
-                ),
-                html.Div(
-                    [
-                        dcc.Interval(
-                            id="daq-interval",
-                            interval=1000,
-                            n_intervals=0,
-                            disabled=True,
-                        ),
-                        daq.PowerButton(
-                            id="daq-powerbutton", on=False, size=100, color="green"
-                        ),
-                        html.Div(id="daq-realtime"),
-                        html.Div(
-                            [
-                                html.A(
-                                    "Dash Daq Document",
-                                    href="https://dash.plot.ly/dash-daq",
-                                )
-                            ],
-                            style={"textAlign": "center"},
-                        ),
-                    ]
-                ),
-                # dash_canvas
-                html.Div(
-                    [html.H2("Dash Canvas", style={"textAlign": "center"})],
-                    style={"backgroundColor": "#fbffb9"},
-                ),
-                html.Div(
-                    [
-                        dcc.Markdown(
-                            """
+                                style=mkstyle_ins,
+                            )
+                        ],
+                        style=mkstyle_ous,
+                    ),
+                    html.Div(
+                        [
+                            dcc.Interval(
+                                id="daq-interval",
+                                interval=1000,
+                                n_intervals=0,
+                                disabled=True,
+                            ),
+                            daq.PowerButton(
+                                id="daq-powerbutton", on=False, size=100, color="green"
+                            ),
+                            html.Div(id="daq-realtime"),
+                            html.Div(
+                                [
+                                    html.A(
+                                        "Dash Daq Document",
+                                        href="https://dash.plot.ly/dash-daq",
+                                    )
+                                ],
+                                style={"textAlign": "center"},
+                            ),
+                        ]
+                    ),
+                    # dash_canvas
+                    html.Div(
+                        [html.H2("Dash Canvas", style={"textAlign": "center"})],
+                        style={"backgroundColor": "#fbffb9"},
+                    ),
+                    html.Div(
+                        [
+                            dcc.Markdown(
+                                """
             - Dash Canvas is drawing and annotation for image processing. 
             - Today I create application that use remove background algorithm.
             - I remove background from my picture.
         """,
-                            style=mkstyle_ins,
-                        )
-                    ],
-                    style=mkstyle_ous,
-                ),
-                html.Div(
-                    [
-                        html.Div(
-                            [
-                                dash_canvas.DashCanvas(
-                                    id="canvas-bg",
-                                    width=500,
-                                    filename=filename,
-                                    lineWidth=8,
-                                    goButtonTitle="Remove background",
-                                    hide_buttons=["line", "zoom", "pan"],
-                                )
-                            ],
-                            style={"display": "inline-block", "marginRight": "5%"},
-                        ),
-                        html.Div(
-                            [html.Img(id="seg-image", width=500)],
-                            style={"display": "inline-block"},
-                        ),
-                        html.Div(
-                            [
-                                html.A(
-                                    "Dash Canvas Document",
-                                    href="https://dash.plot.ly/canvas",
-                                )
-                            ],
-                            style={"margin": "5%", "textAlign": "center"},
-                        ),
-                    ]
-                ),
-                # ---------------------Cytoscape ----------------------------------------------
-                html.Div(
-                    [html.H2("Dash Cytoscape", style={"textAlign": "center"})],
-                    style={"backgroundColor": "#fbffb9"},
-                ),
-                html.Div(
-                    [
-                        dcc.Markdown(
-                            """
+                                style=mkstyle_ins,
+                            )
+                        ],
+                        style=mkstyle_ous,
+                    ),
+                    html.Div(
+                        [
+                            html.Div(
+                                [
+                                    dash_canvas.DashCanvas(
+                                        id="canvas-bg",
+                                        width=500,
+                                        filename=filename,
+                                        lineWidth=8,
+                                        goButtonTitle="Remove background",
+                                        hide_buttons=["line", "zoom", "pan"],
+                                    )
+                                ],
+                                style={"display": "inline-block", "marginRight": "5%"},
+                            ),
+                            html.Div(
+                                [html.Img(id="seg-image", width=500)],
+                                style={"display": "inline-block"},
+                            ),
+                            html.Div(
+                                [
+                                    html.A(
+                                        "Dash Canvas Document",
+                                        href="https://dash.plot.ly/canvas",
+                                    )
+                                ],
+                                style={"margin": "5%", "textAlign": "center"},
+                            ),
+                        ]
+                    ),
+                    # ---------------------Cytoscape ----------------------------------------------
+                    html.Div(
+                        [html.H2("Dash Cytoscape", style={"textAlign": "center"})],
+                        style={"backgroundColor": "#fbffb9"},
+                    ),
+                    html.Div(
+                        [
+                            dcc.Markdown(
+                                """
                         - [Dash Cytoscape](https://github.com/plotly/dash-cytoscape) is a network visualization components. Using Cytoscape.js.
                         - If you click node, node connected with the node will apeears.
                         - Changing the layout changes the way the network looks.
                         - If we choose concentric, we can see what is at the center of the network.
                         - If we choose Breadthfirst, we can see the structure of the network.
                     """,
-                            style=mkstyle_ins,
-                        )
-                    ],
-                    style=mkstyle_ous,
-                ),
-                html.Div(
-                    [
-                        html.Div(
-                            children=[
-                                cyto.Cytoscape(
-                                    id="cytoscape",
-                                    elements=default_elements,
-                                    stylesheet=default_stylesheet,
-                                    style={"height": "60vh"},
-                                )
-                            ],
-                            style={"width": "70%", "float": "left"},
-                        ),
-                        html.Div(
-                            children=[
-                                dcc.Tabs(
-                                    id="tabs",
-                                    children=[
-                                        dcc.Tab(
-                                            label="Control Panel",
-                                            children=[
-                                                NamedDropdown(
-                                                    name="Layout",
-                                                    id="dropdown-layout",
-                                                    options=DropdownOptionsList(
-                                                        "random",
-                                                        "grid",
-                                                        "circle",
-                                                        "concentric",
-                                                        "breadthfirst",
-                                                        "cose",
-                                                    ),
-                                                    value="grid",
-                                                    clearable=False,
-                                                ),
-                                                NamedRadioItems(
-                                                    name="Expand",
-                                                    id="radio-expand",
-                                                    options=DropdownOptionsList(
-                                                        "followers", "following"
-                                                    ),
-                                                    value="followers",
-                                                ),
-                                            ],
-                                        ),
-                                        dcc.Tab(
-                                            label="JSON",
-                                            children=[
-                                                html.Div(
-                                                    style=styles["tab"],
-                                                    children=[
-                                                        html.P("Node Object JSON:"),
-                                                        html.Pre(
-                                                            id="tap-node-json-output",
-                                                            style=styles["json-output"],
+                                style=mkstyle_ins,
+                            )
+                        ],
+                        style=mkstyle_ous,
+                    ),
+                    html.Div(
+                        [
+                            html.Div(
+                                children=[
+                                    cyto.Cytoscape(
+                                        id="cytoscape",
+                                        elements=default_elements,
+                                        stylesheet=default_stylesheet,
+                                        style={"height": "60vh"},
+                                    ),
+                                    dcc.Store(id="cytoscape-expansion"),
+                                    dcc.Store(id="cytoscape-added"),
+                                ],
+                                style={"width": "70%", "float": "left"},
+                            ),
+                            html.Div(
+                                children=[
+                                    dcc.Tabs(
+                                        id="tabs",
+                                        children=[
+                                            dcc.Tab(
+                                                label="Control Panel",
+                                                children=[
+                                                    NamedDropdown(
+                                                        name="Layout",
+                                                        id="dropdown-layout",
+                                                        options=DropdownOptionsList(
+                                                            "random",
+                                                            "grid",
+                                                            "circle",
+                                                            "concentric",
+                                                            "breadthfirst",
+                                                            "cose",
+                                                            "preset",
                                                         ),
-                                                        html.P("Edge Object JSON:"),
-                                                        html.Pre(
-                                                            id="tap-edge-json-output",
-                                                            style=styles["json-output"],
+                                                        value="preset",
+                                                        clearable=False,
+                                                    ),
+                                                    NamedRadioItems(
+                                                        name="Expand",
+                                                        id="radio-expand",
+                                                        options=DropdownOptionsList(
+                                                            "followers", "following"
                                                         ),
-                                                    ],
-                                                )
-                                            ],
-                                        ),
-                                    ],
-                                )
-                            ],
-                            style={"width": "30%", "display": "inline-block"},
-                        ),
-                    ],
-                    style={"height": "63vh"},
-                ),
-                # ----------------------- Dash Bio -----------------------------------------------
-                html.Div(
-                    [
-                        html.Div(
-                            [html.H2("Dash Bio", style={"textAlign": "center"})],
-                            style={"backgroundColor": "#fbffb9"},
-                        ),
-                        html.Div(
-                            [
-                                dcc.Markdown(
-                                    """
+                                                        value="followers",
+                                                    ),
+                                                    NamedRadioItems(
+                                                        name="Hops",
+                                                        id="radio-hops",
+                                                        options=[
+                                                            {
+                                                                "label": str(k),
+                                                                "value": k,
+                                                            }
+                                                            for k in (1, 2, 3)
+                                                        ],
+                                                        value=1,
+                                                    ),
+                                                    html.Button(
+                                                        "Expand all frontier",
+                                                        id="button-expand-frontier",
+                                                        n_clicks=0,
+                                                    ),
+                                                ],
+                                            ),
+                                            dcc.Tab(
+                                                label="JSON",
+                                                children=[
+                                                    html.Div(
+                                                        style=styles["tab"],
+                                                        children=[
+                                                            html.P("Node Object JSON:"),
+                                                            html.Pre(
+                                                                id="tap-node-json-output",
+                                                                style=styles[
+                                                                    "json-output"
+                                                                ],
+                                                            ),
+                                                            html.P("Edge Object JSON:"),
+                                                            html.Pre(
+                                                                id="tap-edge-json-output",
+                                                                style=styles[
+                                                                    "json-output"
+                                                                ],
+                                                            ),
+                                                        ],
+                                                    )
+                                                ],
+                                            ),
+                                        ],
+                                    )
+                                ],
+                                style={"width": "30%", "display": "inline-block"},
+                            ),
+                        ],
+                        style={"height": "63vh"},
+                    ),
+                    # ----------------------- Dash Bio -----------------------------------------------
+                    html.Div(
+                        [
+                            html.Div(
+                                [html.H2("Dash Bio", style={"textAlign": "center"})],
+                                style={"backgroundColor": "#fbffb9"},
+                            ),
+                            html.Div(
+                                [
+                                    dcc.Markdown(
+                                        """
                         - [Dash Bio](https://dash.plot.ly/dash-bio) is Bioinformatics components.
                         - My friend works in bio industry use this components and he said this is useful.
                         """,
-                                    style=mkstyle_ins,
-                                )
-                            ],
-                            style=mkstyle_ous,
-                        ),
-                        html.Div(
-                            [dashbio.Molecule2dViewer(modelData=moljson, width=1500)],
-                            style={"width": "80%", "margin": "auto"},
-                        ),
-                    ]
-                ),
-                html.Div(
-                    [
-                        dcc.Markdown(
-                            """
+                                        style=mkstyle_ins,
+                                    )
+                                ],
+                                style=mkstyle_ous,
+                            ),
+                            html.Div(
+                                [
+                                    dashbio.Molecule2dViewer(
+                                        modelData=moljson, width=1500
+                                    )
+                                ],
+                                style={"width": "80%", "margin": "auto"},
+                            ),
+                        ]
+                    ),
+                    html.Div(
+                        [
+                            dcc.Markdown(
+                                """
                     Sample of these components are on [dash-gallaly](https://dash-gallery.plotly.host/Portal/).
                     Please check it out!
                     """,
-                            style=mkstyle_ins,
-                        )
-                    ],
-                    style=mkstyle_ous,
-                ),
-            ],
-            style={"margin": "5%"},
-        ),
-        html.Div(
-            [dcc.Link("Next: deploy", href="/deploy")],
-            style={"textAlign": "right", "margin": "5%"},
-        ),
-    ]
-)
+                                style=mkstyle_ins,
+                            )
+                        ],
+                        style=mkstyle_ous,
+                    ),
+                ],
+                style={"margin": "5%"},
+            ),
+            html.Div(
+                [dcc.Link("Next: deploy", href="/deploy")],
+                style={"textAlign": "right", "margin": "5%"},
+            ),
+        ]
+    )
+
 
 # dcc sample callback
-@app_dash.callback(
+@memoized_callback(
     Output("show_dccs_graph", "children"),
     [Input("dcc_dd_x", "value"), Input("dcc_dd_y", "value")],
 )
 def update_xy_data_graph(x_value, y_value):
+    gapminder = load("gapminder")
     return dcc.Graph(
         figure=px.scatter(
             gapminder,
@@ -1980,6 +3299,7 @@ def update_xy_data_graph(x_value, y_value):
             hover_name="country",
             log_x=True,
             log_y=True,
+            render_mode=render_mode(len(gapminder)),
             title="Gapminder Chart X: {}, Y: {}".format(x_value, y_value),
         )
     )
@@ -2006,6 +3326,33 @@ def display_output(rows, columns):
     }
 
 
+# 編集された行を id で元のデータに書き戻してから、フィルタと並べ替えをやり直す
+# 元のデータはブラウザの Store に置き、表には今の条件に合う行だけを出す
+@app_dash.callback(
+    [
+        Output("table-editing-simple", "data"),
+        Output("table-editing-simple-store", "data"),
+    ],
+    [
+        Input("table-editing-simple", "filter_query"),
+        Input("table-editing-simple", "sort_by"),
+        Input("table-editing-simple", "data_timestamp"),
+    ],
+    [
+        State("table-editing-simple", "data"),
+        State("table-editing-simple-store", "data"),
+    ],
+    prevent_initial_call=True,
+)
+def update_editing_table(filter_query, sort_by, data_timestamp, rows, all_rows):
+    edited = {row["id"]: row for row in rows or []}
+    all_rows = [edited.get(row["id"], row) for row in all_rows]
+    df = pd.DataFrame(all_rows)
+    for param in params:
+        df[param] = pd.to_numeric(df[param], errors="coerce")
+    return [all_rows[i] for i in table_order(df, filter_query, sort_by)], all_rows
+
+
 # dash_daq sample callback
 @app_dash.callback(Output("daq-interval", "disabled"), [Input("daq-powerbutton", "on")])
 def wakeupCall(switch):
@@ -2019,6 +3366,7 @@ def wakeupCall(switch):
     Output("daq-realtime", "children"), [Input("daq-interval", "n_intervals")]
 )
 def wakeupDaq(n_intervals):
+    daq = load("dash_daq")
     if n_intervals:
         n1 = np.random.random() * 10
         n2 = np.random.random() * 10
@@ -2123,25 +3471,26 @@ def wakeupDaq(n_intervals):
     [Input("canvas-bg", "json_data"), Input("canvas-bg", "image_content")],
 )
 def update_figure(string, image):
+    canvas_utils = load("dash_canvas.utils")
     if string:
         if image is None:
-            im = skimage.io.imread(filepath)
+            im = load("skimage.io").imread(filepath)
         else:
-            im = image_string_to_PILImage(image)
+            im = canvas_utils.image_string_to_PILImage(image)
             im = np.asarray(im)
         shape = im.shape[:2]
         try:
-            mask = parse_jsonstring(string, shape=shape)
+            mask = canvas_utils.parse_jsonstring(string, shape=shape)
         except IndexError:
             raise PreventUpdate
         if mask.sum() > 0:
-            seg = superpixel_color_segmentation(im, mask)
+            seg = canvas_utils.superpixel_color_segmentation(im, mask)
         else:
             seg = np.ones(shape)
         fill_value = 255 * np.ones(3, dtype=np.uint8)
         dat = np.copy(im)
         dat[np.logical_not(seg)] = fill_value
-        return array_to_data_url(dat)
+        return canvas_utils.array_to_data_url(dat)
     else:
         raise PreventUpdate
 
@@ -2167,57 +3516,314 @@ def update_cytoscape_layout(layout):
     return {"name": layout}
 
 
-@app_dash.callback(
-    Output("cytoscape", "elements"),
-    [Input("cytoscape", "tapNodeData")],
-    [State("cytoscape", "elements"), State("radio-expand", "value")],
+# 展開の状態はブラウザごとのセッションとしてサーバー側に持ち、タップのたびに
+# 新しく増えた節点と辺だけを送る。ブラウザ側では受け取った要素を今の要素に足す
+# ブラウザが持つのはセッション id と状態の版番号だけ。複数ワーカーで動かすときは
+# 状態を SQLite (FIGURE_CACHE_PATH と同じ仕組み) に JSON で置き、全ワーカーで共有する
+# 状態が見つからない (別のワーカーのメモリにある) ときや、版が合わない (前の応答が
+# 届く前に続けてタップした) ときは、ブラウザが表示している要素から状態を作り直す
+cyto_session_path = os.environ.get("CYTO_SESSION_PATH") or (
+    os.environ.get("FIGURE_CACHE_PATH") and os.environ["FIGURE_CACHE_PATH"] + ".cyto"
 )
-def generate_elements(nodeData, elements, expansion_mode):
-    if not nodeData:
-        return default_elements
-
-    # If the node has already been expanded, we don't expand it again
-    if nodeData.get("expanded"):
-        return elements
+if cyto_session_path:
+    cyto_sessions = SQLiteCache(
+        cyto_session_path,
+        int(os.environ.get("CYTO_SESSION_BYTES", 64 * 1024 * 1024)),
+        code_version(),
+    )
+else:
+    cyto_sessions = LRUCache(int(os.environ.get("CYTO_SESSIONS", 256)))
+cyto_node_budget = int(os.environ.get("CYTO_NODE_BUDGET", 200))
+cyto_expansions = {
+    "followers": ("followers", "followerNode", "followerEdge"),
+    "following": ("following", "followingNode", "followingEdge"),
+}
 
-    # This retrieves the currently selected element, and tag it as expanded
-    for element in elements:
-        if nodeData["id"] == element.get("data").get("id"):
-            element["data"]["expanded"] = True
-            break
 
-    if expansion_mode == "followers":
+def new_cyto_state(graph):
+    return {
+        "expanded": set(),
+        "nodes": {graph["genesis"]},
+        "edges": set(),
+        "positions": {graph["genesis"]: (0.0, 0.0)},
+        "grid": {(0, 0): [graph["genesis"]]},
+        "version": 0,
+    }
 
-        followers_nodes = followers_node_di.get(nodeData["id"])
-        followers_edges = followers_edges_di.get(nodeData["id"])
 
-        if followers_nodes:
-            for node in followers_nodes:
-                node["classes"] = "followerNode"
-            elements.extend(followers_nodes)
+def save_cyto_state(session, state):
+    if isinstance(cyto_sessions, SQLiteCache):
+        state = json.dumps(
+            {
+                "expanded": sorted(state["expanded"]),
+                "nodes": sorted(state["nodes"]),
+                "edges": sorted(state["edges"]),
+                "positions": [[n, x, y] for n, (x, y) in state["positions"].items()],
+                "version": state["version"],
+            }
+        ).encode()
+    cyto_sessions.set(session, state)
+
+
+def cyto_edge_index(graph, source, target):
+    for direction in cyto_expansions:
+        neighbors, edges = adjacent(graph, direction, source)
+        for n, e in zip(neighbors.tolist(), edges.tolist()):
+            if n == target and graph["sources"][e] == source:
+                return e
+    return None
+
+
+# 展開済みかどうかは要素からはわからないので、今の向きの隣の節点がすべて
+# 表示されている節点を展開済みとみなす
+def cyto_state_from_elements(graph, elements, expansion_mode, version):
+    state = new_cyto_state(graph)
+    state["version"] = version
+    state["grid"] = {}
+    for element in elements or []:
+        data = element.get("data", {})
+        if "source" in data:
+            source = graph["index"].get(data["source"])
+            target = graph["index"].get(data["target"])
+            if source is not None and target is not None:
+                edge = cyto_edge_index(graph, source, target)
+                if edge is not None:
+                    state["edges"].add(edge)
+        elif data.get("id") in graph["index"]:
+            node = graph["index"][data["id"]]
+            position = element.get("position") or {"x": 0.0, "y": 0.0}
+            state["nodes"].add(node)
+            state["positions"][node] = (float(position["x"]), float(position["y"]))
+    for node, position in state["positions"].items():
+        state["grid"].setdefault(layout_cell(position), []).append(node)
+    direction = cyto_expansions[expansion_mode][0]
+    for node in state["nodes"]:
+        neighbors = adjacent(graph, direction, node)[0].tolist()
+        if all(n in state["nodes"] for n in neighbors):
+            state["expanded"].add(node)
+    return state
+
+
+def load_cyto_state(session):
+    state = cyto_sessions.get(session)
+    if state is None or not isinstance(cyto_sessions, SQLiteCache):
+        return state
+    saved = json.loads(state)
+    state = {
+        "expanded": set(saved["expanded"]),
+        "nodes": set(saved["nodes"]),
+        "edges": set(saved["edges"]),
+        "positions": {},
+        "grid": {},
+        "version": saved["version"],
+    }
+    for n, x, y in saved["positions"]:
+        state["positions"][n] = (x, y)
+        state["grid"].setdefault(layout_cell((x, y)), []).append(n)
+    return state
+
+
+# "preset" レイアウト用の座標はサーバー側で計算し、節点の要素に入れて送る
+# 新しい節点だけを、展開元の節点のまわりに置いてから力学モデル (Fruchterman-Reingold)
+# で少しずつ動かす。表示済みの節点は動かさない
+# 斥力を受けるのは、格子 (state["grid"]) で引いた近くの表示済み節点だけで、
+# その数も cyto_layout_neighbors までにする。計算量は増えた節点の数で決まる
+cyto_layout_spacing = 80.0
+cyto_layout_iterations = 50
+cyto_layout_cell = 2 * cyto_layout_spacing
+cyto_layout_neighbors = 500
+
+
+def layout_cell(position):
+    return (
+        int(position[0] // cyto_layout_cell),
+        int(position[1] // cyto_layout_cell),
+    )
 
-        if followers_edges:
-            for follower_edge in followers_edges:
-                follower_edge["classes"] = "followerEdge"
-            elements.extend(followers_edges)
 
-    elif expansion_mode == "following":
+def nearby_nodes(state, positions, reach=2):
+    found, seen = [], set()
+    for x, y in {layout_cell(position) for position in positions}:
+        for dx in range(-reach, reach + 1):
+            for dy in range(-reach, reach + 1):
+                cell = (x + dx, y + dy)
+                if cell not in seen:
+                    seen.add(cell)
+                    found.extend(state["grid"].get(cell, ()))
+    return found[:cyto_layout_neighbors]
+
+
+def layout_new_nodes(graph, state, new_nodes, anchors, new_edges):
+    if not new_nodes:
+        return []
+    new_index = {n: i for i, n in enumerate(new_nodes)}
+
+    # 展開元のまわりにばらまいた位置から始める。乱数の種は状態から決める
+    rng = np.random.default_rng(len(state["positions"]))
+    angles = rng.uniform(0, 2 * np.pi, len(new_nodes))
+    offsets = cyto_layout_spacing * np.stack([np.cos(angles), np.sin(angles)], axis=1)
+    moving = np.empty((len(new_nodes), 2))
+    for i, anchor in enumerate(anchors):
+        if anchor in new_index:
+            moving[i] = moving[new_index[anchor]] + offsets[i]
+        else:
+            moving[i] = np.add(state["positions"][anchor], offsets[i])
 
-        following_nodes = following_node_di.get(nodeData["id"])
-        following_edges = following_edges_di.get(nodeData["id"])
+    endpoints = [
+        n
+        for e in new_edges
+        for n in (graph["sources"][e], graph["targets"][e])
+        if n not in new_index
+    ]
+    fixed = list(dict.fromkeys(nearby_nodes(state, moving) + endpoints))
+    order = {n: i for i, n in enumerate(fixed + list(new_nodes))}
+    fixed_positions = np.array([state["positions"][n] for n in fixed]).reshape(-1, 2)
+
+    sources = np.array([order[graph["sources"][e]] for e in new_edges], dtype=int)
+    targets = np.array([order[graph["targets"][e]] for e in new_edges], dtype=int)
+    k = cyto_layout_spacing
+    for step in range(cyto_layout_iterations):
+        every = np.vstack([fixed_positions, moving])
+        # 近くの節点からの斥力 k^2 / d と、辺に沿った引力 d^2 / k
+        delta = moving[:, None, :] - every[None, :, :]
+        distance2 = np.maximum((delta**2).sum(axis=2), 1e-2)
+        force = np.vstack(
+            [
+                np.zeros_like(fixed_positions),
+                (delta * (k * k / distance2)[..., None]).sum(axis=1),
+            ]
+        )
+        edge = every[sources] - every[targets]
+        pull = edge * (np.sqrt((edge**2).sum(axis=1)) / k)[:, None]
+        np.add.at(force, sources, -pull)
+        np.add.at(force, targets, pull)
+        force = force[len(fixed) :]
+        length = np.maximum(np.sqrt((force**2).sum(axis=1)), 1e-9)
+        temperature = k * (1 - step / cyto_layout_iterations)
+        moving = moving + force * (np.minimum(length, temperature) / length)[:, None]
+
+    for node, position in zip(new_nodes, moving):
+        position = (float(position[0]), float(position[1]))
+        state["positions"][node] = position
+        state["grid"].setdefault(layout_cell(position), []).append(node)
+    return moving
+
+
+# 指定した節点から hops 段まで幅優先で展開する。一度に増やす節点は
+# cyto_node_budget まで。入りきらない節点は展開済みにせず、次の操作で続きを足す
+def expand_nodes(graph, state, nodes, expansion_mode, hops=1):
+    direction, node_class, edge_class = cyto_expansions[expansion_mode]
+    added_nodes, added_edges, anchors = [], [], []
+    visited = set(nodes)
+    frontier = list(nodes)
+    for _ in range(hops):
+        next_frontier = []
+        for node in frontier:
+            neighbors, edges = adjacent(graph, direction, node)
+            neighbors = neighbors.tolist()
+            if node not in state["expanded"]:
+                missing = [
+                    n for n in dict.fromkeys(neighbors) if n not in state["nodes"]
+                ]
+                room = cyto_node_budget - len(added_nodes)
+                if len(missing) > room and added_nodes:
+                    frontier = next_frontier = []
+                    break
+                if len(missing) <= room:
+                    state["expanded"].add(node)
+                state["nodes"].update(missing[:room])
+                added_nodes.extend(missing[:room])
+                anchors.extend([node] * len(missing[:room]))
+            for n, e in zip(neighbors, edges.tolist()):
+                if n not in state["nodes"]:
+                    continue
+                if e not in state["edges"]:
+                    state["edges"].add(e)
+                    added_edges.append(e)
+                if n not in visited:
+                    visited.add(n)
+                    next_frontier.append(n)
+        frontier = next_frontier
+    positions = layout_new_nodes(graph, state, added_nodes, anchors, added_edges)
+    return [
+        cy_node(graph, n, node_class, position)
+        for n, position in zip(added_nodes, positions)
+    ] + [cy_edge(graph, e, edge_class) for e in added_edges]
+
+
+# node_id が None のときは、表示中でまだ展開していない節点をまとめて展開する
+def apply_expansion(graph, state, node_id, expansion_mode, hops):
+    state["version"] += 1
+    if node_id is None:
+        nodes = sorted(state["nodes"] - state["expanded"])
+    else:
+        nodes = [graph["index"][node_id]]
+    return expand_nodes(graph, state, nodes, expansion_mode, hops)
 
-        if following_nodes:
-            for node in following_nodes:
-                if node["data"]["id"] != genesis_node["data"]["id"]:
-                    node["classes"] = "followingNode"
-                    elements.append(node)
 
-        if following_edges:
-            for follower_edge in following_edges:
-                follower_edge["classes"] = "followingEdge"
-            elements.extend(following_edges)
+@app_dash.callback(
+    [Output("cytoscape-added", "data"), Output("cytoscape-expansion", "data")],
+    [
+        Input("cytoscape", "tapNodeData"),
+        Input("button-expand-frontier", "n_clicks"),
+    ],
+    [
+        State("cytoscape-expansion", "data"),
+        State("cytoscape", "elements"),
+        State("radio-expand", "value"),
+        State("radio-hops", "value"),
+    ],
+)
+def generate_elements(
+    nodeData, frontier_clicks, expansion, elements, expansion_mode, hops
+):
+    cyto_graph = load("cyto_graph")
+    if not expansion or not (nodeData or frontier_clicks):
+        expansion = {"session": uuid.uuid4().hex, "version": 0}
+        save_cyto_state(expansion["session"], new_cyto_state(cyto_graph))
+        return {"reset": True, "elements": cyto_graph["default_elements"]}, expansion
+    state = load_cyto_state(expansion["session"])
+    if state is None or state["version"] != expansion["version"]:
+        version = max(expansion["version"], state["version"] if state else 0)
+        state = cyto_state_from_elements(cyto_graph, elements, expansion_mode, version)
+
+    triggered = dash.callback_context.triggered[0]["prop_id"]
+    if triggered.startswith("button-expand-frontier"):
+        node_id = None
+    elif nodeData["id"] in cyto_graph["index"]:
+        node_id = nodeData["id"]
+    else:
+        raise PreventUpdate
 
-    return elements
+    added = apply_expansion(cyto_graph, state, node_id, expansion_mode, hops)
+    save_cyto_state(expansion["session"], state)
+    expansion = {"session": expansion["session"], "version": state["version"]}
+    # Nothing new to show, e.g. the node has already been expanded
+    if not added:
+        return dash.no_update, expansion
+    return {"reset": False, "elements": added}, expansion
+
+
+app_dash.clientside_callback(
+    """
+    function(added, elements) {
+        if (!added) {
+            return window.dash_clientside.no_update;
+        }
+        if (added.reset) {
+            return added.elements;
+        }
+        // 続けてタップしたときは、同じ要素が二つの応答に入っていることがある
+        var ids = new Set((elements || []).map(function(e) { return e.data.id; }));
+        return (elements || []).concat(added.elements.filter(function(e) {
+            return !ids.has(e.data.id);
+        }));
+    }
+    """,
+    Output("cytoscape", "elements"),
+    [Input("cytoscape-added", "data")],
+    [State("cytoscape", "elements")],
+)
 
 
 # ------------------ deploy ----------------------------------------------
@@ -2371,41 +3977,138 @@ def conlusion_update(n_clicks):
 # ------------------------------------------------------------------------
 
 
-@app_dash.callback(Output("contents", "children"), [Input("url", "pathname")])
+# パスとページの対応表。遅延読み込みのページは load() の名前で登録する
+# 新しいページは register_page で追加できる
+page_routes = {}
+
+
+def register_page(pathname, layout):
+    page_routes[pathname] = layout
+
+
+for pathname, layout in [
+    ("/self-introduce", "self_intro"),
+    ("/web-app", web_app),
+    ("/reasons", reasons),
+    ("/menu", menu),
+    ("/merit", "merit"),
+    ("/datavisualization", datavisualization),
+    ("/datavisualization_human", datavisualization_human),
+    ("/interactive_visualization", "interactive_visualization"),
+    ("/visualization_tools", visualization_tools),
+    ("/about_dash", about_dash),
+    ("/dash_basic", dash_basic),
+    ("/dash_graphs", dash_graphs),
+    ("/dash_components", "dash_components"),
+    ("/deploy", deploy),
+    ("/matome", matome),
+]:
+    register_page(pathname, layout)
+
+page_outputs = Output("contents", "children")
+page_inputs = [Input("url", "pathname")]
+
+
+# ページはパスだけで決まるので、シリアライズ済みのものをキャッシュから返す
+# 登録されていないパスはすべてタイトルページとして同じキーにまとめる
+# ページの数は限られているので、図のキャッシュとは別に追い出さずに持っておく
+page_cache = PermanentCache()
+
+
+@memoized_callback(
+    page_outputs,
+    page_inputs,
+    key=lambda pathname: pathname if pathname in page_routes else None,
+    cache=page_cache,
+)
 def update_pages(pathname):
-    if pathname == "/self-introduce":
-        return self_intro
-    elif pathname == "/web-app":
-        return web_app
-    elif pathname == "/reasons":
-        return reasons
-    elif pathname == "/menu":
-        return menu
-    elif pathname == "/merit":
-        return merit
-    elif pathname == "/datavisualization":
-        return datavisualization
-    elif pathname == "/datavisualization_human":
-        return datavisualization_human
-    elif pathname == "/interactive_visualization":
-        return interactive_visualization
-    elif pathname == "/visualization_tools":
-        return visualization_tools
-    elif pathname == "/about_dash":
-        return about_dash
-    elif pathname == "/dash_basic":
-        return dash_basic
-    elif pathname == "/dash_graphs":
-        return dash_graphs
-    elif pathname == "/dash_components":
-        return dash_components
-    elif pathname == "/deploy":
-        return deploy
-    elif pathname == "/matome":
-        return matome
+    layout = page_routes.get(pathname, title)
+    if isinstance(layout, str):
+        return load(layout)
+    return layout
+
+
+# コンポーネントの JS は index を返すときに読み込まれているライブラリの分だけ登録される
+# index はどのワーカーも返すので、コンポーネントのライブラリは起動時に読み込む
+# (dash_bio は sklearn を読むので一番重い)。遅延読み込みにしても、最初の訪問者が待つだけになる
+component_modules = ["dash_bio", "dash_canvas", "dash_daq"]
+for name in component_modules:
+    load(name)
+
+
+preload = os.environ.get("PRELOAD", "")
+for name in lazy_loaders if preload == "all" else filter(None, preload.split(",")):
+    load(name.strip())
+
+# 計測するときは遅延読み込みのものも全部読んでから出力する
+if startup_profile:
+    for name in list(lazy_loaders):
+        load(name)
+    record_stage("module total", import_started)
+    startup_report = json.dumps(
+        {"pid": os.getpid(), "stages": startup_stages}, indent=2, ensure_ascii=False
+    )
+    if startup_profile is True or startup_profile == "-":
+        print(startup_report)
     else:
-        return title
+        with open(startup_profile, "w") as f:
+            f.write(startup_report)
+
+
+# warm-up
+# ------------------------------------------------------------------------
+# WARMUP_MAPS / WARMUP_PAGES=1 で起動時に、=background で起動直後に別スレッドで
+# 全ての年の地図や全てのページをキャッシュに載せる。かかった時間は warmup_report に残し、
+# /metrics で見られる
+
+warmup_report = {}
+
+
+def start_warm_up(setting, warm_up):
+    if setting == "background":
+        threading.Thread(target=warm_up, daemon=True).start()
+    elif setting:
+        warm_up()
+
+
+def warm_up_hotel_maps():
+    start = time.perf_counter()
+    years = ["all"] + load("df_kyoto_hotels_groupby")["year"].tolist()
+    for year in years:
+        warm_callback(
+            hotel_map_outputs, hotel_map_inputs, [{"points": [{"x": year}]}, None]
+        )
+    warmup_report["hotel_maps"] = {
+        "figures": len(years),
+        "seconds": round(time.perf_counter() - start, 3),
+    }
+
+
+def warm_up_pages():
+    start = time.perf_counter()
+    for pathname in ["/"] + list(page_routes):
+        warm_callback(page_outputs, page_inputs, [pathname])
+    warmup_report["pages"] = {
+        "pages": len(page_routes) + 1,
+        "seconds": round(time.perf_counter() - start, 3),
+    }
+
+
+start_warm_up(os.environ.get("WARMUP_MAPS"), warm_up_hotel_maps)
+start_warm_up(os.environ.get("WARMUP_PAGES"), warm_up_pages)
 
 
 if __name__ == "__main__":
-    app_dash.run_server(debug=True)
+    if "--profile-startup" in sys.argv:
+        pass
+    elif "--build-assets" in sys.argv:
+        for csv_path in asset_csvs:
+            build_asset(csv_path)
+            print("built", asset_npz_path(csv_path))
+        save_edge_index(
+            build_cyto_graph(*read_edge_list(cyto_edges_path)),
+            edge_index_path(cyto_edges_path),
+        )
+        print("built", edge_index_path(cyto_edges_path))
+    else:
+        app_dash.run_server(debug=True)
@@ -0,0 +1,39 @@
+import os
+import sys
+
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from application import filter_mask, split_filter_part  # noqa: E402
+
+
+@pytest.mark.parametrize(
+    "filter_part, expected",
+    [
+        ("{sepal_length} ge 5", ("sepal_length", "ge", 5.0)),
+        ("{sepal_length} >= 5", ("sepal_length", "ge", 5.0)),
+        ("{sepal_length} < 4.5", ("sepal_length", "lt", 4.5)),
+        ("{species} = setosa", ("species", "eq", "setosa")),
+        ("{species} != setosa", ("species", "ne", "setosa")),
+        ('{c} contains "one "', ("c", "contains", "one ")),
+        ('{species} = "a le b"', ("species", "eq", "a le b")),
+        ("{species} contains 'it\\'s'", ("species", "contains", "it's")),
+        ('{date} datestartswith "2019"', ("date", "datestartswith", "2019")),
+        ("species = setosa", (None, None, None)),
+        ("", (None, None, None)),
+    ],
+)
+def test_split_filter_part(filter_part, expected):
+    assert split_filter_part(filter_part) == expected
+
+
+def test_filter_mask_keeps_operator_words_inside_values():
+    df = pd.DataFrame({"c": ["someone", "none", "one two"], "n": [1, 2, 3]})
+    assert filter_mask(df, '{c} contains "one "').tolist() == [False, False, True]
+    assert filter_mask(df, '{c} contains "one " && {n} > 2').tolist() == [
+        False,
+        False,
+        True,
+    ]